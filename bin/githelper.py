@@ -1,23 +1,211 @@
 #!/usr/bin/env python
 import argparse
+import atexit
+import concurrent.futures
+import contextlib
+import fcntl
+import fnmatch
+import hashlib
+import inspect
 import json
 import os
 import re
 import shutil
 import subprocess
 import sys
-from functools import cache
-from typing import Any, Dict, List, Literal, Optional, Tuple, overload
+import tempfile
+import threading
+import time
+from functools import cache, wraps
+from typing import (
+    Any,
+    Dict,
+    Iterator,
+    List,
+    Literal,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    overload,
+)
+
+try:
+    import pygit2
+except ImportError:
+    pygit2 = None
 
 DEBUG = False
 USER = os.environ["USER"]
 STACK_RE = re.compile(r"^(.*)\-(\d+)$")
+OID_RE = re.compile(r"^[0-9a-f]{40}$")
+# Batches of cat-file requests larger than this are written from a separate thread
+CAT_FILE_PIPE_SIZE = 16384
+# How far refs_between walks first parents before falling back to git log
+REFS_BETWEEN_WALK_LIMIT = 500
+TRACK_RE = re.compile(r"(ahead|behind) (\d+)")
+# Each stack child's base commit (the parent of its first commit) is recorded here
+BASE_REF_PREFIX = "refs/githelper/base/"
+ZERO_OID = "0" * 40
+HOOK_MARKER = "# Installed by githelper.py"
+HOOKS = ["post-rewrite", "reference-transaction"]
+# Loose objects past this many get packed and added to the reachability bitmap
+MAINTAIN_LOOSE_OBJECTS = 1000
+# Squash merges are only looked for this many commits back on the main branch
+SQUASH_SCAN_DEPTH = 2000
+# stack subcommands that move refs, and so run under the repo lock
+LOCKED_STACK_COMMANDS = {
+    "create",
+    "restack",
+    "tidy",
+    "clean",
+    "rebase",
+    "reset_remote",
+    "delete",
+    "continue",
+    "abort",
+}
+# git subcommands that can move refs. Running any of these drops the ref snapshot.
+REF_COMMANDS = {
+    "branch",
+    "checkout",
+    "cherry-pick",
+    "commit",
+    "fetch",
+    "merge",
+    "pull",
+    "push",
+    "rebase",
+    "reset",
+    "switch",
+    "update-ref",
+}
 
 
 # TODO
 # - Extend a stack that has already been merged by passing in a PR
 
 
+class Tracer:
+    """Records subprocesses and helper calls for --trace, as Chrome trace events"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.start = time.perf_counter()
+        self.events: List[Dict[str, Any]] = []
+        self.lock = threading.Lock()
+
+    def add(self, name: str, cat: str, start: float, args: Dict[str, Any]):
+        end = time.perf_counter()
+        event = {
+            "name": name,
+            "cat": cat,
+            "ph": "X",
+            "ts": (start - self.start) * 1e6,
+            "dur": (end - start) * 1e6,
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": args,
+        }
+        with self.lock:
+            self.events.append(event)
+
+    def add_process(self, argv: Sequence[str], start: float, proc: Any):
+        args: Dict[str, Any] = {"argv": list(argv)}
+        if isinstance(proc, subprocess.CompletedProcess):
+            args["exit"] = proc.returncode
+            args["stdout_bytes"] = len(proc.stdout or b"")
+            args["stderr_bytes"] = len(proc.stderr or b"")
+        else:
+            # Long-lived process. Its requests show up as calls.
+            args["persistent"] = True
+        self.add(" ".join(argv[:2]), "process", start, args)
+
+    def names(self, cat: Optional[str] = None) -> List[str]:
+        return [e["name"] for e in self.events if cat is None or e["cat"] == cat]
+
+    def finish(self):
+        with open(self.path, "w", encoding="utf-8") as ofile:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, ofile)
+        self.print_summary()
+        sys.stderr.write(f"Wrote trace to {self.path}\n")
+
+    def print_summary(self, limit: int = 15):
+        totals: Dict[str, Dict[str, Dict[str, float]]] = {"process": {}, "call": {}}
+        for event in self.events:
+            total = totals[event["cat"]].setdefault(
+                event["name"], {"count": 0, "ms": 0, "bytes": 0}
+            )
+            total["count"] += 1
+            total["ms"] += event["dur"] / 1000
+            total["bytes"] += event["args"].get("stdout_bytes", 0)
+        elapsed = (time.perf_counter() - self.start) * 1000
+        out = sys.stderr
+        out.write(f"Total {elapsed:.0f}ms\n")
+        out.write(f"{'Command':<30} {'Count':>6} {'Total ms':>9} {'Output KB':>10}\n")
+        rows = sorted(totals["process"].items(), key=lambda x: -x[1]["ms"])
+        for name, total in rows[:limit]:
+            kb = total["bytes"] / 1024
+            out.write(
+                f"{name:<30} {total['count']:>6} {total['ms']:>9.1f} {kb:>10.1f}\n"
+            )
+        # Nested calls are included in the time of their callers
+        out.write(f"\n{'Call':<30} {'Count':>6} {'Total ms':>9}\n")
+        rows = sorted(totals["call"].items(), key=lambda x: -x[1]["ms"])
+        for name, total in rows:
+            out.write(f"{name:<30} {total['count']:>6} {total['ms']:>9.1f}\n")
+
+
+_tracer: Optional[Tracer] = None
+
+
+def traced(fn):
+    """Record calls to fn when tracing"""
+    name = fn.__qualname__
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        if _tracer is None:
+            return fn(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _tracer.add(name, "call", start, {})
+
+    return wrapper
+
+
+def trace_methods(cls):
+    """Apply @traced to every method of a class"""
+    for name, value in list(vars(cls).items()):
+        if inspect.isfunction(value) and not name.startswith("__"):
+            setattr(cls, name, traced(value))
+    return cls
+
+
+def run_process(args: Sequence[str], **kwargs) -> subprocess.CompletedProcess:
+    """subprocess.run, recorded when tracing"""
+    if _tracer is None:
+        return subprocess.run(args, **kwargs)
+    check = kwargs.pop("check", False)
+    start = time.perf_counter()
+    proc = subprocess.run(args, **kwargs)
+    _tracer.add_process(args, start, proc)
+    if check:
+        proc.check_returncode()
+    return proc
+
+
+def spawn_process(args: Sequence[str], **kwargs) -> subprocess.Popen:
+    """subprocess.Popen, recorded when tracing"""
+    start = time.perf_counter()
+    proc = subprocess.Popen(args, **kwargs)
+    if _tracer is not None:
+        _tracer.add_process(args, start, proc)
+    return proc
+
+
 def run(*args, **kwargs) -> str:
     kwargs.setdefault("check", True)
     kwargs.setdefault("capture_output", True)
@@ -25,7 +213,7 @@ def run(*args, **kwargs) -> str:
     if DEBUG:
         print("RUN:", args)
     try:
-        stdout = subprocess.run(args, **kwargs).stdout
+        stdout = run_process(args, **kwargs).stdout
     except subprocess.CalledProcessError as e:
         if not silence:
             print("Error running: ", " ".join(args))
@@ -41,10 +229,15 @@ def run(*args, **kwargs) -> str:
 
 
 def git(*args, **kwargs) -> str:
+    if args and args[0] in REF_COMMANDS:
+        invalidate_refs()
     return run(*(("git",) + args), **kwargs)
 
 
 def gh(*args, **kwargs) -> str:
+    if OFFLINE:
+        sys.stderr.write("Can't reach GitHub with --offline\n")
+        sys.exit(1)
     if shutil.which("gh") is None:
         sys.stderr.write("Missing gh executable\n")
         sys.exit(1)
@@ -53,7 +246,7 @@ def gh(*args, **kwargs) -> str:
 
 
 def has_gh() -> bool:
-    proc = subprocess.run(
+    proc = run_process(
         ["gh", "auth", "status"],
         capture_output=True,
         check=False,
@@ -71,7 +264,7 @@ def git_lines(*args, **kwargs) -> List[str]:
 
 @cache
 def remote_main_branch() -> str:
-    proc = subprocess.run(
+    proc = run_process(
         ["git", "symbolic-ref", "refs/remotes/origin/HEAD"],
         capture_output=True,
         check=False,
@@ -85,10 +278,312 @@ def get_origin_master() -> str:
     return "origin/" + remote_main_branch()
 
 
+DEFAULT_REF_PATTERNS = ("refs/heads", "refs/remotes", "refs/githelper/base")
+
+
+class RefSnapshot:
+    """Point-in-time view of the repository refs, loaded with a single for-each-ref
+
+    A partial snapshot only lists the refs that match its patterns. Other refs are looked
+    up in the repository when they are resolved.
+    """
+
+    @traced
+    def __init__(self, patterns: Sequence[str] = DEFAULT_REF_PATTERNS):
+        self.patterns = list(patterns)
+        self.partial = tuple(patterns) != DEFAULT_REF_PATTERNS
+        self.oids: Dict[str, str] = {}
+        self.upstreams: Dict[str, str] = {}
+        self.tracking: Dict[str, Tuple[int, int, bool]] = {}
+        self.branches: List[str] = []
+        self.head = ""
+        self._merged: Dict[str, Set[str]] = {}
+        for refname, oid, is_head, upstream, tracking in backend().list_refs(
+            self.patterns
+        ):
+            self.oids[refname] = oid
+            if not refname.startswith("refs/heads/"):
+                continue
+            branch = refname[len("refs/heads/") :]
+            self.branches.append(branch)
+            if is_head:
+                self.head = branch
+            if upstream:
+                self.upstreams[branch] = upstream
+                self.tracking[branch] = tracking
+
+    def resolve(self, ref: str) -> Optional[str]:
+        """Look up the OID of a ref by full or short name, without running git"""
+        if ref.startswith("refs/"):
+            if not self.covers(ref):
+                return backend().resolve([ref])[0]
+            return self.oids.get(ref)
+        for prefix in ("refs/heads/", "refs/remotes/"):
+            oid = self.oids.get(prefix + ref)
+            if oid is not None:
+                return oid
+            if not self.covers(prefix + ref):
+                return backend().resolve([ref])[0]
+        return None
+
+    def covers(self, ref: str) -> bool:
+        """If the snapshot would have listed this ref, had it existed"""
+        return not self.partial or any(
+            match_ref_pattern(ref, pattern) for pattern in self.patterns
+        )
+
+    def merged(self, target: str) -> Set[str]:
+        """Local branches that are merged into target"""
+        if target not in self._merged:
+            cache = state_cache()
+            target_oid = self.resolve(target) or rev_parse(target)
+            heads = {
+                branch: self.oids["refs/heads/" + branch] for branch in self.branches
+            }
+            # One entry per target, replaced when the target moves, so it can't pile up
+            entry = cache.get("merged", target)
+            known: Dict[str, bool] = {}
+            if entry is not None and entry[0] == target_oid:
+                known = entry[1]
+            if all(oid in known for oid in heads.values()):
+                merged = {branch for branch, oid in heads.items() if known[oid]}
+            else:
+                patterns = [p for p in self.patterns if p.startswith("refs/heads")]
+                merged = {
+                    refname[len("refs/heads/") :]
+                    for refname in backend().merged(target_oid, patterns)
+                }
+                # A partial snapshot only adds to what is known about the other branches
+                if not self.partial:
+                    known = {}
+                known.update({oid: branch in merged for branch, oid in heads.items()})
+                cache.set("merged", target, [target_oid, known])
+            self._merged[target] = merged
+        return self._merged[target]
+
+
+_ref_snapshot: Optional[RefSnapshot] = None
+
+
+# Snapshots are reloaded with the same patterns after they are invalidated
+_ref_patterns: Sequence[str] = DEFAULT_REF_PATTERNS
+
+
+def refs(complete: bool = False) -> RefSnapshot:
+    """The current ref snapshot. With complete, make sure it isn't a partial one."""
+    global _ref_snapshot, _ref_patterns
+    if complete:
+        _ref_patterns = DEFAULT_REF_PATTERNS
+    if _ref_snapshot is None or (complete and _ref_snapshot.partial):
+        _ref_snapshot = RefSnapshot(_ref_patterns)
+    return _ref_snapshot
+
+
+def stack_refs(name: str) -> RefSnapshot:
+    """Snapshot the refs of a single stack, unless all refs are already loaded"""
+    global _ref_snapshot, _ref_patterns
+    patterns = [
+        f"refs/heads/{name}",
+        f"refs/heads/{name}-*",
+        f"refs/remotes/origin/{name}",
+        f"refs/remotes/origin/{name}-*",
+        f"refs/remotes/{get_origin_master()}",
+        f"refs/githelper/base/{name}-*",
+    ]
+    if _ref_snapshot is None or (
+        _ref_snapshot.partial and _ref_snapshot.patterns != patterns
+    ):
+        _ref_patterns = patterns
+        _ref_snapshot = RefSnapshot(patterns)
+    return _ref_snapshot
+
+
+def invalidate_refs():
+    global _ref_snapshot
+    _ref_snapshot = None
+
+
+@cache
+def git_common_dir() -> str:
+    return os.path.abspath(git("rev-parse", "--git-common-dir"))
+
+
+def githelper_path(name: str) -> str:
+    """Path of a file in .git/githelper/, which every worktree shares"""
+    return os.path.join(git_common_dir(), "githelper", name)
+
+
+CACHE_ENABLED = True
+
+
+def cache_path(name: str) -> Optional[str]:
+    """Like githelper_path, but None when caching is disabled with --no-cache"""
+    return githelper_path(name) if CACHE_ENABLED else None
+
+
+def atomic_write(path: str, data: str):
+    """Replace a file in one step, so that a concurrent reader never sees half of it"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as ofile:
+        ofile.write(data)
+    os.replace(tmp, path)
+
+
+@contextlib.contextmanager
+def repo_lock():
+    """Advisory lock on .git/githelper/lock, so githelper processes that move refs queue up"""
+    path = githelper_path("lock")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            sys.stderr.write("Waiting for another githelper process to finish\n")
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+class StateCache:
+    """Persistent cache of derived stack state, stored in .git/githelper/
+
+    Every entry is keyed or tagged with the OIDs that the value was computed from, so it is
+    valid for as long as those refs don't move. Entries that go unused for a while are
+    dropped.
+    """
+
+    MAX_AGE = 30 * 24 * 60 * 60
+    TOUCH_INTERVAL = 24 * 60 * 60
+
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self.entries: Dict[str, Dict[str, List[Any]]] = {}
+        self.stats: Dict[str, List[int]] = {}
+        self.dirty = False
+        self.now = int(time.time())
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as ifile:
+                    self.entries = json.load(ifile)
+            except ValueError:
+                pass
+
+    def get(self, kind: str, key: str) -> Optional[Any]:
+        stats = self.stats.setdefault(kind, [0, 0])
+        entry = self.entries.get(kind, {}).get(key)
+        if entry is None:
+            stats[1] += 1
+            return None
+        stats[0] += 1
+        # Rewriting the whole file just to bump a timestamp would make every read a write
+        if self.now - entry[1] > self.TOUCH_INTERVAL:
+            entry[1] = self.now
+            self.dirty = True
+        return entry[0]
+
+    def set(self, kind: str, key: str, value: Any):
+        self.entries.setdefault(kind, {})[key] = [value, self.now]
+        self.dirty = True
+
+    def save(self):
+        if self.path is None or not self.dirty:
+            return
+        for entries in self.entries.values():
+            for key, (_, last_used) in list(entries.items()):
+                if self.now - last_used > self.MAX_AGE:
+                    del entries[key]
+        atomic_write(self.path, json.dumps(self.entries))
+        self.dirty = False
+
+    def print_stats(self):
+        total_hits = sum(hits for hits, _ in self.stats.values())
+        total = sum(hits + misses for hits, misses in self.stats.values())
+        parts = [
+            f"{kind} {hits}/{hits + misses}"
+            for kind, (hits, misses) in sorted(self.stats.items())
+        ]
+        rate = 100 * total_hits / total if total else 100
+        sys.stderr.write(f"Cache hits: {', '.join(parts)} ({rate:.0f}%)\n")
+
+
+_state_cache: Optional[StateCache] = None
+
+
+def state_cache() -> StateCache:
+    global _state_cache
+    if _state_cache is None:
+        _state_cache = StateCache(cache_path("cache.json"))
+        atexit.register(_state_cache.save)
+    return _state_cache
+
+
+class PatchIdIndex:
+    """Patch ids of the commits on the main branch, for spotting squash-merged children
+
+    It covers start..tip of the main branch and is only ever extended.
+    """
+
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self.tip: Optional[str] = None
+        self.start: Optional[str] = None
+        self.ids: Set[str] = set()
+        if path is not None and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as ifile:
+                header = ifile.readline().split()
+                if len(header) == 2:
+                    self.tip, self.start = header
+                    self.ids = set(ifile.read().split())
+
+    @traced
+    def update(self, tip: str, start: str):
+        """Extend the index to cover at least start..tip"""
+        ranges = []
+        if self.tip is None or self.start is None or not is_ancestor(self.tip, tip):
+            # First use, or the main branch was rewritten
+            self.ids.clear()
+            ranges.append([tip, "^" + start])
+        else:
+            if tip != self.tip:
+                ranges.append([tip, "^" + self.tip])
+            if not is_ancestor(self.start, start):
+                ranges.append([self.start, "^" + start])
+            else:
+                start = self.start
+        if not ranges:
+            return
+        for rev_range in ranges:
+            log = ["log", "-p", "--no-merges", "--format=commit %H", *rev_range]
+            self.ids.update(patch_ids(log).values())
+        self.tip = tip
+        self.start = start
+        self.save()
+
+    def save(self):
+        if self.path is None:
+            return
+        lines = [f"{self.tip} {self.start}"] + sorted(self.ids)
+        atomic_write(self.path, "".join(line + "\n" for line in lines))
+
+
+_patch_id_index: Optional[PatchIdIndex] = None
+
+
+def patch_id_index() -> PatchIdIndex:
+    global _patch_id_index
+    if _patch_id_index is None:
+        # Kept even with --no-cache, since rebuilding it means diffing all of main's history
+        _patch_id_index = PatchIdIndex(githelper_path("patch-ids"))
+    return _patch_id_index
+
+
+@trace_methods
 class Stack:
     def __init__(self, name: str):
         self.name = name
         self._children: List["Child"] = []
+        # A plain branch like bug-12 makes a stack "bug" that has no branch of its own
+        self.has_tip = False
 
     def finalize(self):
         """Record all children that must have been merged"""
@@ -118,81 +613,93 @@ class Stack:
     def all_children(self) -> List["Child"]:
         return [child for child in self._children]
 
-    def load_prs(self):
+    def load_prs(self, use_cache: bool = False):
+        """Load the PRs of the children from the PR cache
+
+        The cache is refreshed first, unless running offline or use_cache is set and the
+        cache was refreshed within the TTL.
+        """
         if not self._children:
             return
-        try:
-            prs = json.loads(
-                gh(
-                    "pr",
-                    "status",
-                    "--json",
-                    "title,body,number,headRefName,url,isDraft",
-                    silence=True,
-                )
-            )
-        except subprocess.CalledProcessError:
-            # This can happen if gh isn't installed, authed, or set up for the current repo
+        online = refresh_pr_cache(use_cache)
+        self.attach_prs(fetch=online)
+
+    def attach_prs(self, fetch: bool = False):
+        """Attach open PRs by branch name, and closed ones through an open PR's table
+
+        Branch names get reused after a PR is merged, so only the table can tie a closed
+        PR to a child. With fetch, closed PRs missing from the cache are fetched.
+        """
+        cache = pr_cache()
+        for child in self._children:
+            pr = cache.get(child.branch)
+            child.pull_request = pr if pr is not None and pr.state == "OPEN" else None
+        known = [child.pull_request for child in self._children if child.pull_request]
+        if not known:
             return
-        pr_map: Dict[str, "PullRequest"] = {
-            pr["headRefName"]: PullRequest.from_json(pr) for pr in prs["createdBy"]
+        missing = {
+            child_idx: pr_num
+            for child_idx, pr_num in known[0].parse_pr_table().items()
+            if child_idx <= len(self._children)
+            and not self._children[child_idx - 1].pull_request
         }
-        for child in self._children:
-            pr = pr_map.get(child.branch)
+        uncached = []
+        for child_idx, pr_num in missing.items():
+            pr = cache.get_number(pr_num)
+            if pr is None:
+                uncached.append(pr_num)
+            else:
+                self._children[child_idx - 1].pull_request = pr
+        if not fetch or not uncached:
+            return
+        fetched = PullRequest.fetch_many(uncached)
+        for child_idx, pr_num in missing.items():
+            pr = fetched.get(pr_num)
             if pr:
-                child.pull_request = pr
-
-        # gh pr status doesn't show closed PRs, so we need to fetch them separately
-        any_new_prs = True
-        while any_new_prs and pr_map and not self._children[0].pull_request:
-            any_new_prs = False
-            prs = [child.pull_request for child in self._children if child.pull_request]
-            if not prs:
-                return
-            first_pr = prs[0]
-            pr_table = first_pr.parse_pr_table()
-            for child_idx, pr_num in pr_table.items():
                 child = self._children[child_idx - 1]
-                if child.pull_request:
-                    continue
-                pr = PullRequest.from_ref(str(pr_num))
                 child.pull_request = pr
-                any_new_prs = True
+                cache.put(child.branch, pr)
 
     def __len__(self) -> int:
         return len(self._children)
 
-    def create_prs(self, before_branch: Optional[str] = None) -> List["Child"]:
+    def create_prs(
+        self, before_branch: Optional[str] = None, jobs: int = 1
+    ) -> List["Child"]:
         total = len(self)
-        created = []
         rel = remote_main_branch()
         body_file = os.path.join(
             git("rev-parse", "--show-toplevel"), ".github", "PULL_REQUEST_TEMPLATE.md"
         )
+        body = ""
+        if os.path.exists(body_file):
+            with open(body_file, "r", encoding="utf-8") as ifile:
+                body = ifile.read()
+        # The base of each PR is just the previous branch, so once the branches are pushed
+        # all of the PRs can be created independently
+        to_create: List[Tuple["Child", str, str]] = []
         for i, child in enumerate(self.unmerged_children(before_branch)):
-            pr = child.pull_request
-            if not pr:
-                commit_line = git_lines("log", "-n", "1", "--format=%B", child.branch)[
-                    0
-                ].strip()
+            if not child.pull_request:
+                oid = rev_parse(child.branch)
+                commit_line = read_commits([oid])[oid].message.splitlines()[0].strip()
                 title = PullRequest.get_title(i + 1, total, commit_line, True)
-                gh(
-                    "pr",
-                    "create",
-                    "--head",
-                    child.branch,
-                    "-B",
-                    rel,
-                    "-d",
-                    "-t",
-                    title,
-                    "-F",
-                    body_file,
-                    capture_output=False,
-                )
-                child.pull_request = PullRequest.from_ref(child.branch)
-                created.append(child)
+                to_create.append((child, rel, title))
             rel = child.branch
+
+        created = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+            futures = [
+                pool.submit(PullRequest.create, child.branch, base, title, body)
+                for child, base, title in to_create
+            ]
+            for (child, _, _), future in zip(to_create, futures):
+                try:
+                    child.pull_request = future.result()
+                except subprocess.CalledProcessError:
+                    sys.stderr.write(f"Failed to create PR for {child.branch}\n")
+                    continue
+                pr_cache().put(child.branch, child.pull_request)
+                created.append(child)
         return created
 
     def update_prs(self) -> List["Child"]:
@@ -212,6 +719,17 @@ class Stack:
             pr = child.pull_request
             if pr is not None and pr.set_table(pull_requests):
                 updated.add(child)
+
+        # This also sends any draft changes made before calling update_prs
+        errors = PullRequest.save_all(pull_requests)
+        cache = pr_cache()
+        for child in self._children:
+            pr = child.pull_request
+            if pr is not None and pr.number in errors:
+                sys.stderr.write(f"Failed to update {pr.url}: {errors[pr.number]}\n")
+                updated.discard(child)
+            elif pr is not None:
+                cache.put(child.branch, pr)
         return list(updated)
 
     def get_next_base(self) -> str:
@@ -228,7 +746,7 @@ class Stack:
 
     def unmerged_branches(self, before_branch: Optional[str] = None) -> List[str]:
         children = [child.branch for child in self.unmerged_children(before_branch)]
-        if before_branch is None or before_branch == self.name:
+        if self.has_tip and (before_branch is None or before_branch == self.name):
             children += [self.name]
         return children
 
@@ -236,55 +754,81 @@ class Stack:
         unmerged_children = self.unmerged_children()
         if not unmerged_children:
             return False
-        for i, top in enumerate(unmerged_children):
-            contains = set(child_branches(top.branch))
-            for child in unmerged_children[i + 1 :]:
-                if child.branch not in contains:
-                    return True
-            if self.name not in contains:
+        # Ancestry is transitive, so the stack is linear iff each branch contains the one
+        # before it
+        branches = [child.branch for child in unmerged_children]
+        if self.has_tip:
+            branches.append(self.name)
+        graph = self.load_graph()
+        for parent, child in zip(branches, branches[1:]):
+            if not graph.is_ancestor(rev_parse(parent), rev_parse(child)):
                 return True
         return False
 
+    def load_graph(self) -> "CommitGraph":
+        """Load the commits of every unmerged branch into the commit graph at once
+
+        The load is deferred until the graph is needed for something the cache can't answer.
+        """
+        graph = commit_graph()
+        graph.prefetch([rev_parse(b) for b in self.unmerged_branches()])
+        return graph
+
     def is_incomplete(self) -> bool:
         unmerged_children = self.unmerged_children()
-        if not unmerged_children:
+        if not unmerged_children or not self.has_tip:
             return False
         return rev_parse(unmerged_children[-1].branch) != rev_parse(self.name)
 
-    def rebase(self, target: Optional[str] = None):
+    def rebase(self, target: Optional[str] = None, worktree: bool = False):
+        """Restack, keeping a journal so that a conflict can be resumed with 'stack continue'"""
+        if RestackJournal.load() is not None:
+            sys.stderr.write(
+                "A restack is already in progress, run 'stack continue' or 'stack abort'\n"
+            )
+            sys.exit(1)
+        journal = self.plan_restack(target, RestackJournal.default_path())
+        if journal.steps:
+            journal.save()
+            run_restack(journal, worktree)
+
+    def plan_restack(
+        self, target: Optional[str] = None, path: Optional[str] = None
+    ) -> "RestackJournal":
+        """Work out which commits move where, before any ref is touched"""
         cur = current_branch()
         unmerged_children = self.unmerged_children()
         if not unmerged_children:
+            steps = []
             if target is not None:
-                git("rebase", target, self.name)
-                switch_branch(cur)
-            return
-        first_child_branch = unmerged_children[0].branch
-        last_child_branch = unmerged_children[-1].branch
-        last_child_rev = rev_parse(last_child_branch)
-        tip_rev = rev_parse(self.name)
-
+                start = merge_base(self.name, target)
+                steps.append(restack_step(self.name, start, rev_parse(target)))
+            return RestackJournal(path, self.name, cur, steps)
+        branches = [child.branch for child in unmerged_children]
+        heads = {branch: rev_parse(branch) for branch in branches + [self.name]}
+        graph = self.load_graph()
+
+        first_child_branch = branches[0]
         if target is not None:
             base = merge_base(first_child_branch, target)
-            parent = find_branch_parent(base, first_child_branch)
-            git("rebase", "--onto", target, parent, first_child_branch)
-
-        root = merge_base(first_child_branch)
-        for i, top in enumerate(unmerged_children[:-1]):
-            next_branch = unmerged_children[i + 1].branch
-            tag_commits(top.branch, f"{root}..{top.branch}")
-            if next_branch not in child_branches(top.branch):
-                first_rev = find_branch_parent(top.branch, next_branch)
-                git("rebase", "--onto", top.branch, first_rev, next_branch)
-            root = top.branch
-
-        if last_child_rev == tip_rev:
-            switch_branch(self.name)
-            git("reset", "--hard", last_child_branch)
-        elif self.name not in child_branches(last_child_branch):
-            git("rebase", "--onto", last_child_branch, last_child_rev, self.name)
-
-        switch_branch(cur)
+            start = find_branch_parent(base, first_child_branch)
+            onto: Optional[str] = rev_parse(target)
+        else:
+            start = onto = merge_base(first_child_branch)
+        steps = []
+        for i, branch in enumerate(branches):
+            if i > 0:
+                prev_branch = branches[i - 1]
+                if graph.is_ancestor(heads[prev_branch], heads[branch]):
+                    start = heads[prev_branch]
+                else:
+                    start = find_branch_parent(prev_branch, branch)
+                onto = None
+            # Every child except the last is tagged
+            tag = branch if i < len(branches) - 1 else None
+            steps.append(restack_step(branch, start, onto, tag, base=True))
+        steps.append(restack_step(self.name, heads[branches[-1]], None))
+        return RestackJournal(path, self.name, cur, steps)
 
     def get_stack_graph(self) -> str:
         return git(
@@ -292,21 +836,215 @@ class Stack:
         )
 
 
+def restack_step(
+    branch: str,
+    start: str,
+    onto: Optional[str],
+    tag: Optional[str] = None,
+    base: bool = False,
+) -> Dict[str, Any]:
+    """Move the commits in start..branch onto a commit, or onto the previous step if None"""
+    return {
+        "branch": branch,
+        "head": rev_parse(branch),
+        "start": start,
+        "onto": onto,
+        "tag": tag,
+        "base": base,
+        "new": None,
+    }
+
+
+class RestackJournal:
+    """The planned steps of a restack and how far it got, stored in .git/githelper/
+
+    Branches only move once every step is done, so an abort just puts back the heads that
+    the plan started from.
+    """
+
+    def __init__(
+        self, path: Optional[str], stack: str, branch: str, steps: List[Dict[str, Any]]
+    ):
+        self.path = path
+        self.stack = stack
+        # The branch to check out again when done
+        self.branch = branch
+        self.steps = steps
+
+    @staticmethod
+    def default_path() -> str:
+        return githelper_path("restack.json")
+
+    @classmethod
+    def load(cls) -> Optional["RestackJournal"]:
+        path = cls.default_path()
+        if not os.path.exists(path):
+            return None
+        with open(path, "r", encoding="utf-8") as ifile:
+            data = json.load(ifile)
+        return cls(path, data["stack"], data["branch"], data["steps"])
+
+    def save(self):
+        if self.path is None:
+            return
+        data = {"stack": self.stack, "branch": self.branch, "steps": self.steps}
+        atomic_write(self.path, json.dumps(data))
+
+    def remove(self):
+        if self.path is not None and os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def onto(self, index: int) -> str:
+        step = self.steps[index]
+        if step["onto"] is not None:
+            return step["onto"]
+        return self.steps[index - 1]["new"]
+
+    @traced
+    def replay(self):
+        """Run the remaining steps by writing the new commits directly to the object database
+
+        On a conflict, the steps before it stay done.
+        """
+        graph = commit_graph()
+        try:
+            for i, step in enumerate(self.steps):
+                if step["new"] is not None:
+                    continue
+                onto = self.onto(i)
+                if step["head"] == step["start"]:
+                    step["new"] = onto
+                    continue
+                # A branch that already builds on onto only needs its commits tagged
+                parent = None if graph.is_ancestor(onto, step["head"]) else onto
+                commits = commit_range(step["start"], step["head"])
+                step["new"] = replay_commits(commits, parent, step["tag"])
+        finally:
+            self.save()
+
+    @traced
+    def rebase(self):
+        """Run the remaining steps with git rebase in the worktree
+
+        A step is safe to rerun: a branch that already builds on its new base is left alone.
+        """
+        graph = commit_graph()
+        for i, step in enumerate(self.steps):
+            if step["new"] is not None:
+                continue
+            branch = step["branch"]
+            onto = self.onto(i)
+            head = rev_parse(branch)
+            if head == step["start"]:
+                update_branches({branch: onto})
+            elif not graph.is_ancestor(onto, head):
+                git("rebase", "--onto", onto, step["start"], branch)
+            if step["tag"]:
+                tag_commits(branch, onto)
+            step["new"] = rev_parse(branch)
+            self.save()
+
+    def finish(self):
+        """Move every branch and record the child bases in one transaction"""
+        new_heads = {step["branch"]: step["new"] for step in self.steps}
+        bases = {
+            step["branch"]: self.onto(i)
+            for i, step in enumerate(self.steps)
+            if step["base"]
+        }
+        update_branches(new_heads, bases=bases)
+        if current_branch() != self.branch:
+            switch_branch(self.branch)
+        self.remove()
+
+    def abort(self):
+        if rebase_in_progress():
+            git("rebase", "--abort")
+        update_branches({step["branch"]: step["head"] for step in self.steps})
+        if current_branch() != self.branch:
+            switch_branch(self.branch)
+        self.remove()
+
+
+def run_restack(journal: RestackJournal, worktree: bool = False):
+    """Run the remaining steps of a restack, leaving the journal behind on a conflict"""
+    if not worktree and supports_merge_tree():
+        try:
+            journal.replay()
+        except MergeConflict as e:
+            print(f"{e}, falling back to git rebase")
+    try:
+        journal.rebase()
+    except subprocess.CalledProcessError:
+        sys.stderr.write(
+            "Resolve the conflicts and run 'githelper.py stack continue', or undo the "
+            "restack with 'githelper.py stack abort'\n"
+        )
+        sys.exit(1)
+    journal.finish()
+
+
+def continue_restack(journal: RestackJournal):
+    """Finish the git rebase that stopped on a conflict, then run the steps after it"""
+    if rebase_in_progress():
+        env = dict(os.environ, GIT_EDITOR="true")
+        try:
+            git("rebase", "--continue", env=env, capture_output=False)
+        except subprocess.CalledProcessError:
+            sys.exit(1)
+    run_restack(journal, worktree=True)
+
+
+def rebase_in_progress() -> bool:
+    return any(
+        os.path.exists(git("rev-parse", "--git-path", name))
+        for name in ["rebase-merge", "rebase-apply"]
+    )
+
+
 PR_TITLE_RE = re.compile(r"^(\[\d+/\d+\])?\s*(WIP:)?\s*(.*)$")
 PR_TABLE_LINE_RE = re.compile(r"^\|\s*(\d+)\s*\|\s*[#>](\d+)")
+PR_GRAPHQL_FIELDS = [
+    "id",
+    "number",
+    "title",
+    "body",
+    "url",
+    "isDraft",
+    "headRefName",
+    "state",
+]
+# Max number of PRs to update in a single GraphQL mutation
+PR_MUTATION_BATCH = 50
+# How many of the user's most recent PRs stack status --all looks at
+PR_LIST_LIMIT = 500
 
 
 class PullRequest:
-    def __init__(self, number: int, title: str, body: str, url: str, is_draft: bool):
+    def __init__(
+        self,
+        number: int,
+        title: str,
+        body: str,
+        url: str,
+        is_draft: bool,
+        node_id: str = "",
+        state: str = "OPEN",
+    ):
         match = PR_TITLE_RE.match(title)
         assert match
         self.number = number
+        self.node_id = node_id
         self.raw_title = title
         self.title = match[3]
         self.raw_body = body
         self.table, self.body = parse_markdown_table(body)
         self.url = url
         self.is_draft = is_draft
+        # OPEN, CLOSED or MERGED
+        self.state = state
+        # Changes made by the setters that have not been sent to GitHub yet
+        self.pending: Dict[str, Any] = {}
 
     def __hash__(self) -> int:
         return self.number
@@ -317,18 +1055,75 @@ class PullRequest:
         return self.number == other.number
 
     @classmethod
-    def from_ref(cls, num_or_branch) -> "PullRequest":
-        return cls.from_json(
-            json.loads(
-                gh(
-                    "pr",
-                    "view",
-                    num_or_branch,
-                    "--json",
-                    "title,body,number,url,isDraft",
-                )
+    @traced
+    def create(
+        cls, head: str, base: str, title: str, body: str, is_draft: bool = True
+    ) -> "PullRequest":
+        """Create a PR, reading its metadata from the REST response"""
+        data = json.loads(
+            gh(
+                "api",
+                "repos/{owner}/{repo}/pulls",
+                "-f",
+                f"head={head}",
+                "-f",
+                f"base={base}",
+                "-f",
+                f"title={title}",
+                "-f",
+                f"body={body}",
+                "-F",
+                f"draft={str(is_draft).lower()}",
+            )
+        )
+        return cls(
+            data["number"],
+            data["title"],
+            data["body"] or "",
+            data["html_url"],
+            data["draft"],
+            data["node_id"],
+        )
+
+    @classmethod
+    @traced
+    def fetch_many(cls, numbers: List[int]) -> Dict[int, "PullRequest"]:
+        """Fetch many PRs with a single GraphQL query"""
+        if not numbers:
+            return {}
+        fields = " ".join(PR_GRAPHQL_FIELDS)
+        query = "\n".join(
+            f"pr{num}: pullRequest(number: {num}) {{ {fields} }}" for num in numbers
+        )
+        data = json.loads(
+            gh(
+                "api",
+                "graphql",
+                "-F",
+                "owner={owner}",
+                "-F",
+                "name={repo}",
+                "-f",
+                "query=query($owner: String!, $name: String!) {"
+                f" repository(owner: $owner, name: $name) {{ {query} }} }}",
             )
         )
+        return {
+            pr["number"]: cls.from_json(pr)
+            for pr in data["data"]["repository"].values()
+            if pr is not None
+        }
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "id": self.node_id,
+            "number": self.number,
+            "title": self.raw_title,
+            "body": self.raw_body,
+            "url": self.url,
+            "isDraft": self.is_draft,
+            "state": self.state,
+        }
 
     @classmethod
     def from_json(cls, json: Dict[str, Any]) -> "PullRequest":
@@ -338,8 +1133,71 @@ class PullRequest:
             json["body"],
             json["url"],
             json["isDraft"],
+            json.get("id", ""),
+            json.get("state", "OPEN"),
         )
 
+    @staticmethod
+    @traced
+    def save_all(prs: Sequence["PullRequest"]) -> Dict[int, str]:
+        """Send the pending changes of many PRs in batched GraphQL mutations
+
+        Returns a mapping of PR number to error message for the PRs that failed.
+        """
+        errors: Dict[int, str] = {}
+        prs = [pr for pr in prs if pr.pending]
+        for i in range(0, len(prs), PR_MUTATION_BATCH):
+            batch = prs[i : i + PR_MUTATION_BATCH]
+            params: List[str] = []
+            variables: List[str] = []
+            mutations: List[str] = []
+            for pr in batch:
+                num = pr.number
+                draft = pr.pending.get("draft")
+                if draft is not None:
+                    # Draft changes go first because the title depends on the draft state
+                    name = (
+                        "convertPullRequestToDraft"
+                        if draft
+                        else "markPullRequestReadyForReview"
+                    )
+                    mutations.append(
+                        f'd{num}: {name}(input: {{pullRequestId: "{pr.node_id}"}})'
+                        " { pullRequest { number } }"
+                    )
+                fields = [f'pullRequestId: "{pr.node_id}"']
+                for key in ("title", "body"):
+                    if key in pr.pending:
+                        fields.append(f"{key}: ${key}{num}")
+                        variables.append(f"${key}{num}: String!")
+                        params.extend(["-f", f"{key}{num}={pr.pending[key]}"])
+                if len(fields) > 1:
+                    mutations.append(
+                        f"u{num}: updatePullRequest(input: {{{', '.join(fields)}}})"
+                        " { pullRequest { number } }"
+                    )
+            decl = f"({', '.join(variables)})" if variables else ""
+            query = f"mutation{decl} {{ {' '.join(mutations)} }}"
+            try:
+                data = json.loads(
+                    gh("api", "graphql", *params, "-f", "query=" + query, silence=True)
+                )
+            except subprocess.CalledProcessError as e:
+                # GraphQL errors exit non-zero, but still report per-alias results
+                try:
+                    data = json.loads(e.stdout.decode("utf-8"))
+                except ValueError:
+                    data = {"errors": [{"message": e.stderr.decode("utf-8").strip()}]}
+            results = data.get("data") or {}
+            messages = [err.get("message", "") for err in data.get("errors", [])]
+            for pr in batch:
+                aliases = [f"d{pr.number}", f"u{pr.number}"]
+                if results and all(results.get(a, True) is not None for a in aliases):
+                    pr.pending.clear()
+                else:
+                    errors[pr.number] = "; ".join(messages) or "update failed"
+        return errors
+
     def parse_pr_table(self) -> Dict[int, int]:
         """Return a mapping of child index to PR number"""
         ret = {}
@@ -357,7 +1215,7 @@ class PullRequest:
     def set_title(self, index: int, total: int, title: str) -> bool:
         new_title = self.get_title(index, total, title, self.is_draft)
         if new_title != self.raw_title:
-            gh("pr", "edit", str(self.number), "-t", new_title, capture_output=False)
+            self.pending["title"] = new_title
             self.title = title
             self.raw_title = new_title
             return True
@@ -367,10 +1225,7 @@ class PullRequest:
     def set_draft(self, is_draft: bool) -> bool:
         if is_draft == self.is_draft:
             return False
-        args = ["pr", "ready", str(self.number)]
-        if is_draft:
-            args.append("--undo")
-        gh(*args, capture_output=False)
+        self.pending["draft"] = is_draft
         self.is_draft = is_draft
         return True
 
@@ -387,7 +1242,7 @@ class PullRequest:
         table = make_markdown_table(rows, ["", "PR", "Title"])
         if table != self.table:
             new_body = table + "\n" + self.body
-            gh("pr", "edit", str(self.number), "-b", new_body, capture_output=False)
+            self.pending["body"] = new_body
             self.raw_body = new_body
             self.table = table
             return True
@@ -395,6 +1250,112 @@ class PullRequest:
             return False
 
 
+class PullRequestCache:
+    """The user's PRs by head branch, stored in .git/githelper/prs
+
+    A refresh lists the number and updatedAt of every PR in one cheap query, then fetches
+    only the PRs that changed since the last refresh.
+    """
+
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        # When the cache was last refreshed from GitHub
+        self.checked = 0.0
+        self.prs: Dict[str, Dict[str, Any]] = {}
+        self.dirty = False
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as ifile:
+                    data = json.load(ifile)
+                self.checked = data["checked"]
+                self.prs = data["prs"]
+            except (ValueError, KeyError):
+                pass
+
+    def is_fresh(self) -> bool:
+        return time.time() - self.checked < PR_CACHE_TTL
+
+    def get(self, branch: str) -> Optional[PullRequest]:
+        pr = self.prs.get(branch)
+        return None if pr is None else PullRequest.from_json(pr)
+
+    def get_number(self, number: int) -> Optional[PullRequest]:
+        for pr in self.prs.values():
+            if pr["number"] == number:
+                return PullRequest.from_json(pr)
+        return None
+
+    def put(self, branch: str, pr: PullRequest, updated_at: str = ""):
+        """Store a PR. Without updated_at, the next refresh fetches it again."""
+        self.prs[branch] = dict(pr.to_json(), updatedAt=updated_at)
+        self.dirty = True
+
+    @traced
+    def refresh(self):
+        # With nothing to compare against, list everything in the one query
+        full_listing = not self.prs
+        fields = ["number", "headRefName", "updatedAt"]
+        if full_listing:
+            fields = PR_GRAPHQL_FIELDS + ["updatedAt"]
+        try:
+            listed = json.loads(
+                gh(
+                    "pr",
+                    "list",
+                    "--author",
+                    "@me",
+                    "--state",
+                    "all",
+                    "--limit",
+                    str(PR_LIST_LIMIT),
+                    "--json",
+                    ",".join(fields),
+                    silence=True,
+                )
+            )
+        except subprocess.CalledProcessError:
+            # This can happen if gh isn't authed or set up for the current repo
+            return
+        # Newest first, so the newest PR wins when a branch name was reused
+        latest: Dict[str, Dict[str, Any]] = {}
+        for pr in listed:
+            latest.setdefault(pr["headRefName"], pr)
+        changed = [
+            pr
+            for branch, pr in latest.items()
+            if self.prs.get(branch, {}).get("updatedAt") != pr["updatedAt"]
+        ]
+        if full_listing:
+            fetched = {pr["number"]: PullRequest.from_json(pr) for pr in changed}
+        else:
+            fetched = PullRequest.fetch_many([pr["number"] for pr in changed])
+        for pr in changed:
+            full = fetched.get(pr["number"])
+            if full is not None:
+                self.put(pr["headRefName"], full, pr["updatedAt"])
+        self.checked = time.time()
+        self.dirty = True
+
+    def save(self):
+        if self.path is None or not self.dirty:
+            return
+        atomic_write(self.path, json.dumps({"checked": self.checked, "prs": self.prs}))
+        self.dirty = False
+
+
+PR_CACHE_TTL = float(os.environ.get("GITHELPER_PR_TTL", "300"))
+OFFLINE = False
+_pr_cache: Optional[PullRequestCache] = None
+
+
+def pr_cache() -> PullRequestCache:
+    global _pr_cache
+    if _pr_cache is None:
+        _pr_cache = PullRequestCache(cache_path("prs"))
+        atexit.register(_pr_cache.save)
+    return _pr_cache
+
+
 class Child:
     stack_name: str
     index: int
@@ -423,6 +1384,19 @@ class Child:
         return self.branch == other.branch
 
 
+def refresh_pr_cache(use_cache: bool = False) -> bool:
+    """Refresh the PR cache unless use_cache is set and it is within the TTL
+
+    Returns False if GitHub can't be reached, in which case the cache is used as-is.
+    """
+    if OFFLINE or shutil.which("gh") is None:
+        return False
+    cache = pr_cache()
+    if not (use_cache and cache.is_fresh()):
+        cache.refresh()
+    return True
+
+
 def parse_markdown_table(body: str) -> Tuple[str, str]:
     table = []
     rest = []
@@ -458,25 +1432,94 @@ def make_markdown_table(data: List[Dict[str, str]], cols: List[str]) -> str:
 
 
 def list_branches() -> List[str]:
-    return [b.strip() for b in git_lines("branch", "--format=%(refname:short)")]
+    return list(refs(complete=True).branches)
 
 
-def list_merged_branches(branch: Optional[str] = None) -> List[str]:
+def list_merged_branches(branch: Optional[str] = None) -> Set[str]:
     if branch is None:
         branch = get_origin_master()
-    return [
-        b.strip()
-        for b in git_lines("branch", "--format=%(refname:short)", "--merged", branch)
-    ]
+    merged = refs().merged(branch)
+    if branch == get_origin_master():
+        merged = merged | list_squash_merged_branches(merged)
+    return merged
+
+
+@traced
+def list_squash_merged_branches(merged: Set[str]) -> Set[str]:
+    """Stack children whose changes landed on the main branch as different commits"""
+    main = rev_parse(get_origin_master())
+    cache = state_cache()
+    heads = {
+        branch: rev_parse(branch)
+        for branch in refs().branches
+        if branch not in merged and STACK_RE.match(branch)
+    }
+    branch_ids: Dict[str, List[Optional[str]]] = {}
+    todo: Dict[str, Tuple[str, str]] = {}
+    for branch, base in main_branch_parents(heads).items():
+        head = heads[branch]
+        # The patch ids only depend on the child, so they stay valid while main moves
+        ids = cache.get("squash-ids", f"{base}:{head}")
+        if ids is None:
+            todo[branch] = (base, head)
+        else:
+            branch_ids[branch] = ids
+    if not todo and not branch_ids:
+        return set()
+
+    index = patch_id_index()
+    start = index.start
+    if todo or start is None:
+        forks = [heads[branch] for branch in (todo or branch_ids)]
+        start = git("merge-base", "--octopus", main, *forks)
+        # An old abandoned child mustn't make every run diff years of history. Children
+        # squash-merged before the cut-off only count as merged if git sees them as such.
+        floor = backend().resolve([f"{main}~{SQUASH_SCAN_DEPTH}"])[0]
+        if floor is not None and not is_ancestor(floor, start):
+            start = floor
+    index.update(main, start)
+
+    if todo:
+        # A squash merge matches the whole diff of a child, a rebase merge each commit
+        squashed = patch_ids(
+            ["diff-tree", "--stdin", "-p"],
+            "".join(f"{head} {base}\n" for base, head in todo.values()),
+        )
+        commits = {
+            branch: commit_range(base, head) for branch, (base, head) in todo.items()
+        }
+        rebased = patch_ids(
+            ["diff-tree", "--stdin", "-p"],
+            "".join(oid + "\n" for oids in commits.values() for oid in oids),
+        )
+        for branch, (base, head) in todo.items():
+            ids = [squashed.get(head)]
+            ids.extend(rebased[oid] for oid in commits[branch] if oid in rebased)
+            cache.set("squash-ids", f"{base}:{head}", ids)
+            branch_ids[branch] = ids
+
+    ret = set()
+    for branch, (squash_id, *commit_ids) in branch_ids.items():
+        if squash_id in index.ids or (
+            commit_ids and all(i in index.ids for i in commit_ids)
+        ):
+            ret.add(branch)
+    return ret
 
 
 def current_branch() -> str:
-    return git("branch", "--show-current")
+    snapshot = _ref_snapshot
+    if snapshot is None or (snapshot.partial and not snapshot.head):
+        return backend().head_branch()
+    return snapshot.head
 
 
 def delete_branch(branch: str, force: bool = False):
     flag = "-D" if force else "-d"
-    return git("branch", flag, branch)
+    ret = git("branch", flag, branch)
+    if refs().resolve(BASE_REF_PREFIX + branch) is not None:
+        git("update-ref", "-d", BASE_REF_PREFIX + branch)
+    return ret
 
 
 def current_stack() -> str:
@@ -501,7 +1544,14 @@ def get_stack(name: str, required: bool = False) -> Optional[Stack]:
 def get_stack(name: str, required: bool = False) -> Optional[Stack]:
     if name == "." or name == "@":
         name = current_stack()
-    for stack in list_stacks():
+    # Only list this stack's refs, rather than classifying every branch in the repo
+    snapshot = stack_refs(name)
+    branches = [
+        branch
+        for branch in snapshot.branches
+        if branch == name or STACK_RE.sub(r"\1", branch) == name
+    ]
+    for stack in group_stacks(branches, list_merged_branches()):
         if stack.name == name:
             return stack
     if required:
@@ -521,10 +1571,15 @@ def get_repo_url() -> str:
     return url
 
 
+@traced
 def list_stacks() -> List[Stack]:
+    branches = list_branches()
+    return group_stacks(branches, list_merged_branches())
+
+
+def group_stacks(branches: List[str], merged: Set[str]) -> List[Stack]:
     stacks: Dict[str, Stack] = {}
-    merged = list_merged_branches()
-    for branch in list_branches():
+    for branch in branches:
         is_merged = branch in merged
         match = STACK_RE.match(branch)
         if match:
@@ -534,8 +1589,10 @@ def list_stacks() -> List[Stack]:
             stacks[name].add_child(
                 Child(name, num, is_merged=is_merged, local_exists=True)
             )
-        elif branch not in stacks:
-            stacks[branch] = Stack(branch)
+        else:
+            if branch not in stacks:
+                stacks[branch] = Stack(branch)
+            stacks[branch].has_tip = True
 
     ret = list(stacks.values())
     for stack in ret:
@@ -543,22 +1600,100 @@ def list_stacks() -> List[Stack]:
     return ret
 
 
+@traced
 def refs_between(ref1: str, ref2: str) -> List[str]:
     """Exclusive on ref1, inclusive on ref2"""
+    # Usually ref1 is an ancestor of a linear ref2, which cat-file can walk without forking
+    base = rev_parse(ref1)
+    cur = rev_parse(ref2)
+    ret = []
+    while cur != base and len(ret) < REFS_BETWEEN_WALK_LIMIT:
+        parents = read_commits([cur])[cur].parents
+        if len(parents) != 1:
+            break
+        ret.append(cur)
+        cur = parents[0]
+    if cur == base:
+        ret.reverse()
+        return ret
     return list(reversed(git_lines("log", ref1 + "..." + ref2, "--format=%H")))
 
 
+@traced
 def get_tag(ref: str) -> Optional[str]:
-    lines = git_lines("log", "-n", "1", "--format=%B", ref)
-    for line in lines:
+    oid = rev_parse(ref)
+    for line in read_commits([oid])[oid].message.splitlines():
         if line.startswith("branch: "):
             return line[8:].strip()
+    # Rewording a commit by hand drops its trailer. The post-rewrite hook remembers it.
+    return state_cache().get("tag", oid)
 
 
+@traced
 def find_branch_parent(target: str, branch: str) -> str:
+    base = indexed_branch_parent(branch)
+    if base is not None:
+        return base
+    cache = state_cache()
+    key = f"{rev_parse(target)}:{rev_parse(branch)}:{branch}"
+    ret = cache.get("parent", key)
+    if ret is None:
+        ret = _find_branch_parent(target, branch)
+        cache.set("parent", key, ret)
+    return ret
+
+
+def indexed_branch_parent(branch: str) -> Optional[str]:
+    """The recorded base of a child, if the branch still builds directly on it"""
+    base = refs().resolve(BASE_REF_PREFIX + branch)
+    if base is None:
+        return None
+    path = commit_graph().first_parent_path(base, rev_parse(branch))
+    # Commits for another branch after the base mean it was rewritten without us
+    if not path or get_tag(path[0]) not in (None, branch):
+        return None
+    return base
+
+
+def main_branch_parents(heads: Dict[str, str]) -> Dict[str, str]:
+    """find_branch_parent against the main branch for many children at once
+
+    Children are walked in the commit graph, instead of asking git for a merge base each.
+    Children without a tagged commit are left out.
+    """
+    graph = commit_graph()
+    graph.prefetch(list(heads.values()))
+    ret = {}
+    chains = {}
+    for branch, head in heads.items():
+        base = indexed_branch_parent(branch)
+        if base is not None:
+            ret[branch] = base
+            continue
+        chain = graph.first_parent_chain(head)
+        if chain:
+            chains[branch] = chain
+            continue
+        try:
+            ret[branch] = find_branch_parent(get_origin_master(), branch)
+        except ValueError:
+            pass
+    oids = list(dict.fromkeys(oid for chain in chains.values() for oid in chain))
+    read_commits(oids)
+    tags = {oid: get_tag(oid) for oid in oids}
+    for branch, chain in chains.items():
+        for i, oid in enumerate(chain):
+            if tags[oid] == branch:
+                ret[branch] = chain[i - 1] if i else graph.parents[oid][0]
+                break
+    return ret
+
+
+def _find_branch_parent(target: str, branch: str) -> str:
     branch_mb = merge_base(target, branch)
 
     commits = refs_between(branch_mb, branch)
+    read_commits(commits)
     prev = branch_mb
     for commit in commits:
         if get_tag(commit) == branch:
@@ -568,115 +1703,866 @@ def find_branch_parent(target: str, branch: str) -> str:
     raise ValueError(f"Could not find branch start for {branch}")
 
 
+@traced
 def rev_parse(ref: str) -> str:
-    return git("rev-parse", "--verify", ref)
+    if OID_RE.match(ref):
+        return ref
+    oid = refs().resolve(ref)
+    if oid is None:
+        oid = backend().resolve([ref])[0]
+        if oid is None:
+            raise ValueError(f"Unknown revision {ref}")
+    return oid
+
+
+@traced
+def is_ancestor(ancestor: str, ref: str) -> bool:
+    if ancestor == ref:
+        return True
+    return backend().is_ancestor(ancestor, ref)
 
 
-def tag_commits(tag: str, refs: str):
-    filter = (
-        r"""awk '/^branch:/ {found=1} END {if(!found) print "\nbranch: """
-        + tag
-        + """"} 1'"""
-    )
-    proc = subprocess.run(
-        [
-            "git",
-            "filter-branch",
-            "-f",
-            "--msg-filter",
-            filter,
-            refs,
-        ],
-        env={"FILTER_BRANCH_SQUELCH_WARNING": "1"},
-        capture_output=True,
-        check=False,
-    )
-    if proc.returncode != 0:
-        stderr = proc.stderr.decode("utf-8").strip()
-        if stderr != "Found nothing to rewrite":
-            raise subprocess.CalledProcessError(
-                proc.returncode, proc.args, proc.stdout, proc.stderr
-            )
+def tag_commits(branch: str, base: str):
+    """Add a branch trailer to the commits in base..branch that don't have one"""
+    commits = commit_range(rev_parse(base), rev_parse(branch))
+    if commits:
+        update_branches({branch: replay_commits(commits, None, branch)})
 
 
-def merge_base(branch: str, ref2: Optional[str] = None) -> str:
-    if ref2 is None:
-        ref2 = get_origin_master()
-    return git("merge-base", branch, ref2)
+class MergeConflict(Exception):
+    pass
 
 
-def child_branches(ref: str) -> List[str]:
-    return [
-        b
-        for b in git_lines("branch", "--contains", ref, "--format=%(refname:short)")
-        if b != ref
-    ]
+@cache
+def git_version() -> Tuple[int, ...]:
+    match = re.search(r"(\d+)\.(\d+)", git("--version"))
+    assert match
+    return (int(match[1]), int(match[2]))
 
 
-def make_stack(branch: Optional[str] = None):
-    exit_if_dirty()
-    cur = current_branch()
-    if branch is None or branch == "." or branch == "@":
-        branch = current_stack()
-    stack = get_stack(branch)
-    if stack is None:
-        raise ValueError(f"Could not create stack for branch {branch}")
-    # Make sure we're on a tidy stack first
-    stack.rebase()
-    base = stack.get_next_base()
-    for commit in refs_between(base, stack.name):
-        child = stack.create_next_child()
-        git("checkout", "-b", child.branch, commit)
-        child.local_exists = True
-        tag_commits(child.branch, f"{child.branch}^..{child.branch}")
-        stack.add_child(child)
+def supports_merge_tree() -> bool:
+    # merge-tree --merge-base was added in git 2.40
+    return git_version() >= (2, 40)
 
-    # The tip should be the same as the last child branch
-    switch_branch(stack.name)
-    git("reset", "--hard", stack.unmerged_children()[-1].branch)
-    stack.rebase()
-    switch_branch(cur)
 
+class CommitInfo:
+    oid: str
+    tree: str
+    parents: List[str]
+    author: str
+    committer: str
+    message: str
+    # Headers other than the ones above, minus signatures that a rewrite would invalidate
+    extra_headers: List[str]
 
-def switch_branch(branch: str):
-    git("checkout", branch)
+    def __init__(
+        self,
+        oid: str,
+        tree: str,
+        parents: List[str],
+        author: str,
+        committer: str,
+        message: str,
+        extra_headers: Optional[List[str]] = None,
+    ):
+        self.oid = oid
+        self.tree = tree
+        self.parents = parents
+        self.author = author
+        self.committer = committer
+        self.message = message
+        self.extra_headers = extra_headers or []
 
+    @classmethod
+    def parse(cls, oid: str, raw: bytes) -> "CommitInfo":
+        header, _, message = raw.decode("utf-8", "surrogateescape").partition("\n\n")
+        info = cls(oid, "", [], "", "", message)
+        key = ""
+        for line in header.splitlines():
+            if line.startswith(" "):
+                # Continuation of a multi-line header
+                if key not in ("gpgsig", "gpgsig-sha256", "mergetag"):
+                    info.extra_headers[-1] += "\n" + line
+                continue
+            key, _, value = line.partition(" ")
+            if key == "tree":
+                info.tree = value
+            elif key == "parent":
+                info.parents.append(value)
+            elif key == "author":
+                info.author = value
+            elif key == "committer":
+                info.committer = value
+            elif key not in ("gpgsig", "gpgsig-sha256", "mergetag"):
+                info.extra_headers.append(line)
+        return info
+
+    def serialize(self) -> bytes:
+        lines = [f"tree {self.tree}"]
+        lines.extend(f"parent {parent}" for parent in self.parents)
+        lines.append(f"author {self.author}")
+        lines.append(f"committer {self.committer}")
+        lines.extend(self.extra_headers)
+        raw = "\n".join(lines) + "\n\n" + self.message
+        return raw.encode("utf-8", "surrogateescape")
+
+
+class CatFile:
+    """Long-lived git cat-file process for resolving revs and reading objects
+
+    Requests are pipelined: all of a batch is written before the responses are read.
+    """
+
+    def __init__(self):
+        # --batch-command answers both kinds of request from a single process
+        self.batch_command = git_version() >= (2, 36)
+        self.procs: Dict[str, subprocess.Popen] = {}
+
+    def _proc(self, mode: str) -> subprocess.Popen:
+        key = "command" if self.batch_command else mode
+        proc = self.procs.get(key)
+        if proc is None:
+            flag = {
+                "command": "--batch-command",
+                "info": "--batch-check",
+                "contents": "--batch",
+            }[key]
+            proc = spawn_process(
+                ["git", "cat-file", flag], stdin=subprocess.PIPE, stdout=subprocess.PIPE
+            )
+            self.procs[key] = proc
+        return proc
+
+    def _request(
+        self, mode: str, revs: Sequence[str]
+    ) -> List[Optional[Tuple[str, str, bytes]]]:
+        proc = self._proc(mode)
+        assert proc.stdin and proc.stdout
+        prefix = mode + " " if self.batch_command else ""
+        data = "".join(prefix + rev + "\n" for rev in revs).encode("utf-8")
+        writer = None
+        if len(data) < CAT_FILE_PIPE_SIZE:
+            proc.stdin.write(data)
+            proc.stdin.flush()
+        else:
+            # A large batch could fill both pipes and deadlock if written from this thread
+            def write():
+                assert proc.stdin
+                proc.stdin.write(data)
+                proc.stdin.flush()
+
+            writer = threading.Thread(target=write)
+            writer.start()
+        ret: List[Optional[Tuple[str, str, bytes]]] = []
+        for _ in revs:
+            header = proc.stdout.readline().decode("utf-8").split()
+            if len(header) != 3:
+                # "<rev> missing" or "<rev> ambiguous"
+                ret.append(None)
+                continue
+            oid, obj_type, size = header
+            contents = b""
+            if mode == "contents":
+                contents = proc.stdout.read(int(size))
+                proc.stdout.read(1)
+            ret.append((oid, obj_type, contents))
+        if writer is not None:
+            writer.join()
+        return ret
 
-def create_branch(branch: str, start: Optional[str] = None):
-    if start is None:
-        start = remote_main_branch()
-    git("checkout", "-b", branch, start)
+    @traced
+    def resolve(self, revs: Sequence[str]) -> List[Optional[str]]:
+        """Resolve revs to object ids, like rev-parse --verify"""
+        return [item[0] if item else None for item in self._request("info", revs)]
+
+    @traced
+    def read(self, revs: Sequence[str]) -> List[Tuple[str, str, bytes]]:
+        """Return the oid, type and contents of objects"""
+        ret = []
+        for rev, item in zip(revs, self._request("contents", revs)):
+            if item is None:
+                raise ValueError(f"Could not read object {rev}")
+            ret.append(item)
+        return ret
 
 
-def touch_file(filename: str, contents: str = ""):
-    with open(filename, "w", encoding="utf-8") as ofile:
-        ofile.write(contents)
+class ObjectWriter:
+    """Long-lived git hash-object process for writing commits without forking git"""
+
+    def __init__(self):
+        fd, self.path = tempfile.mkstemp(prefix="githelper-")
+        os.close(fd)
+        atexit.register(os.unlink, self.path)
+        self.proc = spawn_process(
+            [
+                "git",
+                "hash-object",
+                "-w",
+                "-t",
+                "commit",
+                "--stdin-paths",
+                "--no-filters",
+            ],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
 
+    @traced
+    def write(self, raw: bytes) -> str:
+        assert self.proc.stdin and self.proc.stdout
+        with open(self.path, "wb") as ofile:
+            ofile.write(raw)
+        self.proc.stdin.write(self.path.encode("utf-8") + b"\n")
+        self.proc.stdin.flush()
+        return self.proc.stdout.readline().decode("utf-8").strip()
+
+
+# (refname, oid, is HEAD, upstream refname, (ahead, behind, upstream is gone))
+RefInfo = Tuple[str, str, bool, str, Tuple[int, int, bool]]
+
+
+@trace_methods
+class GitBackend:
+    """Repository access for the stack logic, implemented by running git
+
+    This is the reference implementation. Other backends must give identical results
+    (see 'githelper.py test backends').
+    """
+
+    name = "subprocess"
+
+    def __init__(self):
+        self._cat_file: Optional[CatFile] = None
+        self._object_writer: Optional[ObjectWriter] = None
+
+    def cat_file(self) -> CatFile:
+        if self._cat_file is None:
+            self._cat_file = CatFile()
+        return self._cat_file
+
+    def list_refs(self, patterns: Sequence[str]) -> List[RefInfo]:
+        ret = []
+        for line in git_lines(
+            "for-each-ref",
+            "--format=%(refname)%00%(HEAD)%00%(objectname)%00%(upstream)%00%(upstream:track)",
+            *patterns,
+        ):
+            refname, is_head, oid, upstream, track = line.split("\0")
+            counts = {k: int(v) for k, v in TRACK_RE.findall(track)}
+            tracking = (
+                counts.get("ahead", 0),
+                counts.get("behind", 0),
+                track == "[gone]",
+            )
+            ret.append((refname, oid, is_head == "*", upstream, tracking))
+        return ret
 
-def exit_if_no_gh():
-    if not has_gh():
-        sys.stderr.write("gh cli missing or not authenticated\n")
-        sys.exit(1)
+    def head_branch(self) -> str:
+        """The checked-out branch, or an empty string if HEAD is detached"""
+        proc = run_process(
+            ["git", "symbolic-ref", "-q", "--short", "HEAD"],
+            capture_output=True,
+            check=False,
+        )
+        return proc.stdout.decode("utf-8").strip()
 
+    def merged(self, target: str, patterns: Sequence[str]) -> Set[str]:
+        """Refs that are ancestors of target"""
+        return set(
+            git_lines(
+                "for-each-ref", "--format=%(refname)", "--merged", target, *patterns
+            )
+        )
 
-def exit_if_dirty():
-    output = git("status", "--porcelain")
-    if output:
-        sys.stderr.write("Working directory is dirty\n")
-        sys.exit(1)
+    def merge_base(self, ref1: str, ref2: str) -> str:
+        return git("merge-base", ref1, ref2)
 
+    def is_ancestor(self, ancestor: str, ref: str) -> bool:
+        proc = run_process(
+            ["git", "merge-base", "--is-ancestor", ancestor, ref],
+            capture_output=True,
+            check=False,
+        )
+        return proc.returncode == 0
 
-def _add_cmd_stack(parser: argparse.ArgumentParser):
-    subparsers = parser.add_subparsers(dest="stack_cmd")
+    def ahead_behind(self, local: str, upstream: str) -> Tuple[int, int]:
+        out = git("rev-list", "--left-right", "--count", f"{local}...{upstream}")
+        ahead, behind = out.split()
+        return int(ahead), int(behind)
 
-    list_parser = subparsers.add_parser(
-        "list", help="List all branches, filtering out stack children"
-    )
-    list_parser.add_argument(
-        "-c",
-        "--children",
-        action="store_true",
-        help="Print the number of children each stack has",
+    def rev_list(self, tips: Sequence[str], exclude: str) -> Dict[str, List[str]]:
+        """Map of commit to parents for every commit in tips that isn't in exclude"""
+        ret = {}
+        for line in git_lines("rev-list", "--parents", *tips, "^" + exclude):
+            oid, *parents = line.split()
+            ret[oid] = parents
+        return ret
+
+    def resolve(self, revs: Sequence[str]) -> List[Optional[str]]:
+        return self.cat_file().resolve(revs)
+
+    def read(self, oids: Sequence[str]) -> List[Tuple[str, bytes]]:
+        """Return the type and raw contents of objects"""
+        return [(obj_type, raw) for _, obj_type, raw in self.cat_file().read(oids)]
+
+    def write_commit(self, raw: bytes) -> str:
+        if self._object_writer is None:
+            self._object_writer = ObjectWriter()
+        return self._object_writer.write(raw)
+
+    def update_refs(self, updates: Sequence[Tuple[str, str, str]], reason: str):
+        """Atomically move refs, given as (refname, new oid, expected old oid or "")"""
+        lines = [
+            f"update {ref} {new} {old}".rstrip() + "\n" for ref, new, old in updates
+        ]
+        git("update-ref", "-m", reason, "--stdin", input="".join(lines).encode("utf-8"))
+
+
+@trace_methods
+class Pygit2Backend(GitBackend):
+    """In-process backend that reads the repository with libgit2
+
+    Ref updates still go through git so that hooks and reflogs behave as usual.
+    """
+
+    name = "pygit2"
+
+    def __init__(self):
+        super().__init__()
+        assert pygit2 is not None
+        self.repo = pygit2.Repository(pygit2.discover_repository(os.getcwd()))
+
+    def list_refs(self, patterns: Sequence[str]) -> List[RefInfo]:
+        head = "" if self.repo.head_is_detached else self.repo.head.name
+        ret = []
+        for refname in sorted(self.repo.listall_references()):
+            if not any(match_ref_pattern(refname, pattern) for pattern in patterns):
+                continue
+            ref = self.repo.references[refname]
+            if ref.type != pygit2.enums.ReferenceType.DIRECT:
+                ref = ref.resolve()
+            oid = str(ref.target)
+            upstream = ""
+            tracking = (0, 0, False)
+            if refname.startswith("refs/heads/"):
+                branch = self.repo.branches.local[refname[len("refs/heads/") :]]
+                try:
+                    upstream = branch.upstream_name
+                except (KeyError, pygit2.GitError):
+                    pass
+                if upstream:
+                    upstream_ref = self.repo.references.get(upstream)
+                    if upstream_ref is None:
+                        tracking = (0, 0, True)
+                    else:
+                        ahead, behind = self.repo.ahead_behind(
+                            ref.target, upstream_ref.resolve().target
+                        )
+                        tracking = (ahead, behind, False)
+            ret.append((refname, oid, refname == head, upstream, tracking))
+        return ret
+
+    def head_branch(self) -> str:
+        head = self.repo.references["HEAD"]
+        if head.type == pygit2.enums.ReferenceType.SYMBOLIC and head.target.startswith(
+            "refs/heads/"
+        ):
+            return head.target[len("refs/heads/") :]
+        return ""
+
+    def merged(self, target: str, patterns: Sequence[str]) -> Set[str]:
+        target_oid = pygit2.Oid(hex=target)
+        ret = set()
+        for refname, oid, _, _, _ in self.list_refs(patterns):
+            if oid == target or self.repo.descendant_of(
+                target_oid, pygit2.Oid(hex=oid)
+            ):
+                ret.add(refname)
+        return ret
+
+    def merge_base(self, ref1: str, ref2: str) -> str:
+        oid = self.repo.merge_base(
+            self.repo.revparse_single(ref1).id, self.repo.revparse_single(ref2).id
+        )
+        if oid is None:
+            raise ValueError(f"No merge base for {ref1} and {ref2}")
+        return str(oid)
+
+    def is_ancestor(self, ancestor: str, ref: str) -> bool:
+        return ancestor == ref or self.repo.descendant_of(
+            self.repo.revparse_single(ref).id, self.repo.revparse_single(ancestor).id
+        )
+
+    def ahead_behind(self, local: str, upstream: str) -> Tuple[int, int]:
+        return self.repo.ahead_behind(
+            self.repo.revparse_single(local).id, self.repo.revparse_single(upstream).id
+        )
+
+    def rev_list(self, tips: Sequence[str], exclude: str) -> Dict[str, List[str]]:
+        walker = self.repo.walk(None)
+        for tip in tips:
+            walker.push(pygit2.Oid(hex=tip))
+        walker.hide(self.repo.revparse_single(exclude).id)
+        return {
+            str(commit.id): [str(p) for p in commit.parent_ids] for commit in walker
+        }
+
+    def resolve(self, revs: Sequence[str]) -> List[Optional[str]]:
+        ret: List[Optional[str]] = []
+        for rev in revs:
+            try:
+                ret.append(str(self.repo.revparse_single(rev).id))
+            except (KeyError, ValueError, pygit2.GitError):
+                ret.append(None)
+        return ret
+
+    def read(self, oids: Sequence[str]) -> List[Tuple[str, bytes]]:
+        ret = []
+        for oid in oids:
+            obj_type, raw = self.repo.odb.read(oid)
+            ret.append((PYGIT2_OBJECT_TYPES[obj_type], raw))
+        return ret
+
+    def write_commit(self, raw: bytes) -> str:
+        return str(self.repo.odb.write(pygit2.enums.ObjectType.COMMIT, raw))
+
+
+PYGIT2_OBJECT_TYPES = {1: "commit", 2: "tree", 3: "blob", 4: "tag"}
+
+
+def match_ref_pattern(refname: str, pattern: str) -> bool:
+    """Match a ref the way for-each-ref does: by glob, or by whole path components"""
+    if any(c in pattern for c in "*?["):
+        return fnmatch.fnmatchcase(refname, pattern)
+    return refname == pattern or refname.startswith(pattern.rstrip("/") + "/")
+
+
+BACKEND = os.environ.get("GITHELPER_BACKEND", "auto")
+_backend: Optional[GitBackend] = None
+_commit_info: Dict[str, CommitInfo] = {}
+
+
+# pygit2.enums, which Pygit2Backend relies on, was added in 1.14
+PYGIT2_MIN_VERSION = (1, 14)
+
+
+def pygit2_supported() -> bool:
+    if pygit2 is None or not hasattr(pygit2, "enums"):
+        return False
+    version = re.findall(r"\d+", pygit2.__version__)[:2]
+    return tuple(map(int, version)) >= PYGIT2_MIN_VERSION
+
+
+def backend() -> GitBackend:
+    global _backend
+    if _backend is None:
+        if BACKEND == "pygit2" or (BACKEND == "auto" and pygit2_supported()):
+            if not pygit2_supported():
+                version = ".".join(map(str, PYGIT2_MIN_VERSION))
+                sys.stderr.write(f"The pygit2 backend requires pygit2 >= {version}\n")
+                sys.exit(1)
+            _backend = Pygit2Backend()
+        else:
+            _backend = GitBackend()
+    return _backend
+
+
+def reset_backend(name: str):
+    """Switch to another backend and drop everything that was read through the old one"""
+    global BACKEND, _backend, _commit_graph
+    BACKEND = name
+    _backend = None
+    _commit_graph = None
+    _commit_info.clear()
+    invalidate_refs()
+
+
+@traced
+def write_commit(info: CommitInfo) -> str:
+    info.oid = backend().write_commit(info.serialize())
+    _commit_info[info.oid] = info
+    return info.oid
+
+
+@traced
+def read_commits(oids: Sequence[str]) -> Dict[str, CommitInfo]:
+    missing = [oid for oid in dict.fromkeys(oids) if oid not in _commit_info]
+    if missing:
+        for oid, (obj_type, raw) in zip(missing, backend().read(missing)):
+            if obj_type != "commit":
+                raise ValueError(f"{oid} is a {obj_type}, not a commit")
+            _commit_info[oid] = CommitInfo.parse(oid, raw)
+    return {oid: _commit_info[oid] for oid in oids}
+
+
+@cache
+def committer_ident() -> str:
+    return git("var", "GIT_COMMITTER_IDENT")
+
+
+def get_tree(oid: str) -> str:
+    return read_commits([oid])[oid].tree
+
+
+def commit_range(base: str, tip: str) -> List[str]:
+    """Commits in base..tip, oldest first"""
+    commits = commit_graph().first_parent_path(base, tip)
+    if commits is None:
+        commits = git_lines("rev-list", "--reverse", "--topo-order", base + ".." + tip)
+    return commits
+
+
+def add_branch_tag(message: str, tag: str) -> str:
+    for line in message.splitlines():
+        if line.startswith("branch:"):
+            return message
+    return message.rstrip("\n") + "\n\nbranch: " + tag + "\n"
+
+
+@traced
+def replay_commits(
+    commits: List[str], onto: Optional[str] = None, tag: Optional[str] = None
+) -> str:
+    """Cherry-pick commits onto a new base without touching the worktree
+
+    If onto is None, the commits keep their parent and are only re-tagged. Commits whose
+    parent and message are unchanged are reused as-is. Returns the new tip.
+    """
+    infos = read_commits(commits)
+    for commit in commits:
+        info = infos[commit]
+        if len(info.parents) != 1:
+            raise MergeConflict(f"Cannot replay merge commit {commit[:10]}")
+        parent = info.parents[0]
+        if onto is None:
+            onto = parent
+        message = add_branch_tag(info.message, tag) if tag else info.message
+        if parent == onto and message == info.message:
+            onto = commit
+            continue
+        new_info = CommitInfo(
+            "",
+            info.tree,
+            [onto],
+            info.author,
+            info.committer,
+            message,
+            info.extra_headers,
+        )
+        if get_tree(onto) != get_tree(parent):
+            proc = run_process(
+                [
+                    "git",
+                    "merge-tree",
+                    "--write-tree",
+                    "--merge-base=" + parent,
+                    onto,
+                    commit,
+                ],
+                capture_output=True,
+                check=False,
+            )
+            if proc.returncode != 0:
+                raise MergeConflict(f"Conflict replaying {commit[:10]}")
+            new_info.tree = proc.stdout.decode("utf-8").splitlines()[0]
+            new_info.committer = committer_ident()
+        onto = write_commit(new_info)
+    assert onto is not None
+    return onto
+
+
+@traced
+def update_branches(
+    new_heads: Dict[str, str],
+    reason: str = "githelper",
+    bases: Optional[Dict[str, str]] = None,
+):
+    """Move branches in one update-ref transaction, then sync the worktree if needed
+
+    bases are recorded in the child base index in the same transaction. Branches that
+    don't exist yet are created, and the transaction fails if one appeared in the meantime.
+    """
+    snapshot = refs()
+    old_heads = {
+        branch: snapshot.resolve("refs/heads/" + branch) or ZERO_OID
+        for branch in new_heads
+    }
+    changed = {
+        branch: oid for branch, oid in new_heads.items() if oid != old_heads[branch]
+    }
+    updates = [
+        ("refs/heads/" + branch, oid, old_heads[branch])
+        for branch, oid in changed.items()
+    ] + [
+        (BASE_REF_PREFIX + branch, oid, "")
+        for branch, oid in (bases or {}).items()
+        if snapshot.resolve(BASE_REF_PREFIX + branch) != oid
+    ]
+    if not updates:
+        return
+    cur = current_branch()
+    backend().update_refs(updates, reason)
+    if cur in changed and get_tree(old_heads[cur]) != get_tree(changed[cur]):
+        git("read-tree", "-m", "-u", old_heads[cur], changed[cur])
+
+
+def patch_ids(args: Sequence[str], input: str = "") -> Dict[str, str]:
+    """Map of commit to patch id for the patches that a git command prints"""
+    diff = spawn_process(["git", *args], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    assert diff.stdin and diff.stdout
+
+    # Written from a separate thread so that a full pipe can't deadlock us
+    def write():
+        assert diff.stdin
+        diff.stdin.write(input.encode("utf-8"))
+        diff.stdin.close()
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    proc = run_process(
+        ["git", "patch-id", "--stable"],
+        stdin=diff.stdout,
+        capture_output=True,
+        check=True,
+    )
+    writer.join()
+    diff.stdout.close()
+    diff.wait()
+    ret = {}
+    for line in proc.stdout.decode("utf-8").splitlines():
+        patch_id, oid = line.split()
+        ret[oid] = patch_id
+    return ret
+
+
+@traced
+def merge_base(branch: str, ref2: Optional[str] = None) -> str:
+    if ref2 is None:
+        ref2 = get_origin_master()
+    cache = state_cache()
+    key = f"{rev_parse(branch)}:{rev_parse(ref2)}"
+    ret = cache.get("merge-base", key)
+    if ret is None:
+        ret = backend().merge_base(branch, ref2)
+        cache.set("merge-base", key, ret)
+    return ret
+
+
+class CommitGraph:
+    """In-memory ancestry DAG of the commits that are not yet on the main branch
+
+    Commits are immutable, so the graph only ever grows and stays valid while refs move.
+    """
+
+    def __init__(self, exclude: str):
+        self.exclude = exclude
+        self.parents: Dict[str, List[str]] = {}
+        # Commits that are reachable from the excluded base
+        self.outside: Set[str] = set()
+        self._ancestors: Dict[str, Set[str]] = {}
+        self._pending: List[str] = []
+
+    def prefetch(self, tips: Sequence[str]):
+        """Queue tips to be loaded along with the next load"""
+        self._pending.extend(tips)
+
+    @traced
+    def load(self, tips: Sequence[str]):
+        tips = [
+            tip
+            for tip in dict.fromkeys(tips)
+            if tip not in self.parents and tip not in self.outside
+        ]
+        if tips and self._pending:
+            tips = self._pending + tips
+            self._pending = []
+            tips = [
+                tip
+                for tip in dict.fromkeys(tips)
+                if tip not in self.parents and tip not in self.outside
+            ]
+        if not tips:
+            return
+        self.parents.update(backend().rev_list(tips, self.exclude))
+        for tip in tips:
+            if tip not in self.parents:
+                self.outside.add(tip)
+
+    def ancestors(self, oid: str) -> Set[str]:
+        """All ancestors of a commit inside the graph, including itself"""
+        ret = self._ancestors.get(oid)
+        if ret is None:
+            ret = set()
+            stack = [oid]
+            while stack:
+                cur = stack.pop()
+                if cur in ret or cur not in self.parents:
+                    continue
+                ret.add(cur)
+                stack.extend(self.parents[cur])
+            self._ancestors[oid] = ret
+        return ret
+
+    def is_ancestor(self, ancestor: str, ref: str) -> bool:
+        if ancestor == ref:
+            return True
+        # Ancestry between two commits never changes, so it can be cached forever
+        cache = state_cache()
+        key = ancestor + ":" + ref
+        ret = cache.get("ancestry", key)
+        if ret is None:
+            self.load([ancestor, ref])
+            if ancestor in self.parents:
+                # If ref was reachable from the base, so would be all of its ancestors
+                ret = ref in self.parents and ancestor in self.ancestors(ref)
+            else:
+                # The ancestor is behind the base, which the graph can't see past
+                ret = is_ancestor(ancestor, ref)
+            cache.set("ancestry", key, ret)
+        return ret
+
+    def first_parent_path(self, base: str, tip: str) -> Optional[List[str]]:
+        """Linear commits in base..tip, oldest first, or None if the graph can't tell"""
+        self.load([tip])
+        ret = []
+        cur = tip
+        while cur != base:
+            parents = self.parents.get(cur)
+            if parents is None or len(parents) != 1:
+                return None
+            ret.append(cur)
+            cur = parents[0]
+        ret.reverse()
+        return ret
+
+    def first_parent_chain(self, tip: str) -> Optional[List[str]]:
+        """Linear commits from the edge of the graph to tip, oldest first"""
+        self.load([tip])
+        ret = []
+        cur = tip
+        while cur in self.parents:
+            parents = self.parents[cur]
+            if len(parents) != 1:
+                return None
+            ret.append(cur)
+            cur = parents[0]
+        ret.reverse()
+        return ret
+
+
+_commit_graph: Optional[CommitGraph] = None
+
+
+def commit_graph() -> CommitGraph:
+    global _commit_graph
+    if _commit_graph is None:
+        _commit_graph = CommitGraph(rev_parse(get_origin_master()))
+    return _commit_graph
+
+
+@traced
+def make_stack(branch: Optional[str] = None):
+    """Turn every commit after the last child into a new child branch
+
+    The children are tagged in one rewrite pass and created in one ref transaction, without
+    checking anything out.
+    """
+    exit_if_dirty()
+    if branch is None or branch == "." or branch == "@":
+        branch = current_stack()
+    stack = get_stack(branch)
+    if stack is None:
+        raise ValueError(f"Could not create stack for branch {branch}")
+    # Make sure we're on a tidy stack first
+    stack.rebase()
+    base = stack.get_next_base()
+    new_heads: Dict[str, str] = {}
+    bases: Dict[str, str] = {}
+    onto: Optional[str] = None
+    for commit in refs_between(base, stack.name):
+        child = stack.create_next_child()
+        child.local_exists = True
+        stack.add_child(child)
+        bases[child.branch] = onto or rev_parse(base)
+        onto = replay_commits([commit], onto, child.branch)
+        new_heads[child.branch] = onto
+    if onto is None:
+        return
+    # The tip should be the same as the last child branch
+    new_heads[stack.name] = onto
+    update_branches(new_heads, "githelper: stack create", bases=bases)
+
+
+@traced
+def push_branches(branches: List[str], force: bool = False):
+    """Push branches to origin in one atomic push and set their upstreams"""
+    git_args = ["push", "--atomic", "-u"]
+    if force:
+        snapshot = refs()
+        for branch in branches:
+            # An empty expected value means the branch must not exist on the remote yet
+            expect = snapshot.resolve("refs/remotes/origin/" + branch) or ""
+            git_args.append(f"--force-with-lease=refs/heads/{branch}:{expect}")
+    git_args.append("origin")
+    git_args.extend(f"refs/heads/{branch}:refs/heads/{branch}" for branch in branches)
+    git(*git_args, capture_output=False)
+
+
+@traced
+def fetch_branches(branches: List[str]):
+    """Fetch just these branches from origin, skipping ones that origin doesn't have"""
+    snapshot = refs()
+    refspecs = [
+        f"+refs/heads/{branch}:refs/remotes/origin/{branch}"
+        for branch in branches
+        if snapshot.resolve("refs/remotes/origin/" + branch) is not None
+    ]
+    if refspecs:
+        git("fetch", "origin", *refspecs, capture_output=False)
+
+
+def switch_branch(branch: str):
+    git("checkout", branch)
+
+
+def create_branch(branch: str, start: Optional[str] = None):
+    if start is None:
+        start = remote_main_branch()
+    git("checkout", "-b", branch, start)
+
+
+def touch_file(filename: str, contents: str = ""):
+    with open(filename, "w", encoding="utf-8") as ofile:
+        ofile.write(contents)
+
+
+def exit_if_no_gh():
+    if OFFLINE:
+        sys.stderr.write("Can't reach GitHub with --offline\n")
+        sys.exit(1)
+    if not has_gh():
+        sys.stderr.write("gh cli missing or not authenticated\n")
+        sys.exit(1)
+
+
+def exit_if_dirty():
+    output = git("status", "--porcelain")
+    if output:
+        sys.stderr.write("Working directory is dirty\n")
+        sys.exit(1)
+
+
+def _add_cmd_stack(parser: argparse.ArgumentParser):
+    subparsers = parser.add_subparsers(dest="stack_cmd")
+
+    list_parser = subparsers.add_parser(
+        "list", help="List all branches, filtering out stack children"
+    )
+    list_parser.add_argument(
+        "-c",
+        "--children",
+        action="store_true",
+        help="Print the number of children each stack has",
     )
     subparsers.add_parser(
         "create",
@@ -692,6 +2578,12 @@ def _add_cmd_stack(parser: argparse.ArgumentParser):
     restack_parser.add_argument(
         "name", nargs="?", default=".", help="Name of the branch to restack"
     )
+    restack_parser.add_argument(
+        "-w",
+        "--worktree",
+        action="store_true",
+        help="Restack with git rebase in the worktree instead of rewriting refs in place",
+    )
     clean_parser = subparsers.add_parser(
         "clean", help="Delete the merged branches of a stack"
     )
@@ -711,6 +2603,13 @@ def _add_cmd_stack(parser: argparse.ArgumentParser):
         action="store_true",
         help="Create PRs for all branches, not just the earlier ones",
     )
+    pr_parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=4,
+        help="Number of PRs to create concurrently",
+    )
     pr_parser.add_argument("name", nargs="?", default=".", help="Name of the stack")
     publish_parser = subparsers.add_parser(
         "publish", help="Publish stack PRs from draft mode"
@@ -770,15 +2669,97 @@ def _add_cmd_stack(parser: argparse.ArgumentParser):
         "rebase", help="rebase a stack on top of a rev"
     )
     rebase_parser.add_argument("target", help="Target revision to rebase onto")
-    subparsers.add_parser(
+    rebase_parser.add_argument(
+        "-w",
+        "--worktree",
+        action="store_true",
+        help="Rebase with git rebase in the worktree instead of rewriting refs in place",
+    )
+    reset_remote_parser = subparsers.add_parser(
         "reset_remote",
         help="Reset stack branches to origin refs",
         description="This is useful if you've edited and pushed a stack from another machine",
     )
+    reset_remote_parser.add_argument(
+        "--fetch",
+        action="store_true",
+        help="Fetch only the stack's branches from origin first",
+    )
+    subparsers.add_parser(
+        "continue", help="Resume a restack or rebase that stopped on a conflict"
+    )
+    subparsers.add_parser(
+        "abort", help="Put the branches of a stopped restack or rebase back"
+    )
     status_parser = subparsers.add_parser("status", help="Display status of the stack")
     status_parser.add_argument(
         "name", nargs="?", default=".", help="Name of the stack to show the status of"
     )
+    status_parser.add_argument(
+        "-a",
+        "--all",
+        action="store_true",
+        help="Show every stack, with the PRs from a single query",
+    )
+    status_parser.add_argument(
+        "--fetch",
+        action="store_true",
+        help="Fetch only the stack's branches from origin first",
+    )
+
+
+def print_stack_status(stack: Stack):
+    header = [stack.name]
+    tracking = tracking_status(stack.name) if stack.has_tip else "(no tip branch)"
+    if tracking:
+        header.append(tracking)
+    if stack.needs_restack():
+        header.append("(needs restack)")
+    if stack.is_incomplete():
+        header.append("(has unstacked commits)")
+    print(" ".join(header))
+    for child in reversed(stack.all_children()):
+        pr = child.pull_request
+        line = [child.branch]
+        if pr:
+            line.append(f"#{pr.number}")
+        if child.is_merged or (pr and pr.state == "MERGED"):
+            line.append(f"(merged)")
+            print(" ".join(line))
+            continue
+        if pr and pr.state == "CLOSED":
+            line.append("(closed)")
+        elif pr and pr.is_draft:
+            line.append("(draft)")
+        if child.local_exists:
+            tracking = tracking_status(child.branch)
+            if tracking:
+                line.append(tracking)
+        print(" ".join(line))
+
+
+def tracking_status(branch: str) -> str:
+    """How a branch compares to its upstream, from the ref snapshot's %(upstream:track)
+
+    A branch that was pushed without setting an upstream is compared to origin/<branch>.
+    """
+    snapshot = refs()
+    parts = []
+    if branch in snapshot.upstreams:
+        ahead, behind, gone = snapshot.tracking[branch]
+        if gone:
+            return "(upstream gone)"
+    else:
+        remote = snapshot.resolve("refs/remotes/origin/" + branch)
+        if remote is None:
+            return "(not pushed)"
+        ahead, behind = backend().ahead_behind(rev_parse(branch), remote)
+        parts.append("no upstream")
+    if ahead:
+        parts.append(f"ahead {ahead}")
+    if behind:
+        parts.append(f"behind {behind}")
+    return f"({', '.join(parts)})" if parts else ""
 
 
 def navigate_stack_relative(count: int):
@@ -809,30 +2790,24 @@ def cmd_stack(args, parser):
     elif args.stack_cmd == "restack":
         exit_if_dirty()
         stack = get_stack(args.name, required=True)
-        stack.rebase()
+        stack.rebase(worktree=args.worktree)
     elif args.stack_cmd == "clean":
         stack = get_stack(args.name, required=True)
         for child in stack.all_children():
             if child.is_merged and child.local_exists:
                 print("delete", child.branch)
-                delete_branch(child.branch)
+                # git branch -d can't tell that a squash-merged child has landed
+                delete_branch(child.branch, force=True)
     elif args.stack_cmd == "push":
         stack = get_stack(".", required=True)
-        cur = current_branch()
-        before_branch = None if args.a else cur
-        for branch in stack.unmerged_branches(before_branch):
-            switch_branch(branch)
-            git_args = ["push", "-u", "origin", branch]
-            if args.f:
-                git_args.insert(1, "--force-with-lease")
-            git(*git_args, capture_output=False)
-        switch_branch(cur)
+        before_branch = None if args.a else current_branch()
+        push_branches(stack.unmerged_branches(before_branch), args.f)
     elif args.stack_cmd == "pr":
         exit_if_no_gh()
         stack = get_stack(args.name, required=True)
         stack.load_prs()
         before_branch = None if args.a else current_branch()
-        created = stack.create_prs(before_branch)
+        created = stack.create_prs(before_branch, args.jobs)
         updated = stack.update_prs()
         for child in stack._children:
             pr = child.pull_request
@@ -882,7 +2857,16 @@ def cmd_stack(args, parser):
     elif args.stack_cmd == "rebase":
         exit_if_dirty()
         stack = get_stack(".", required=True)
-        stack.rebase(args.target)
+        stack.rebase(args.target, worktree=args.worktree)
+    elif args.stack_cmd in ["continue", "abort"]:
+        journal = RestackJournal.load()
+        if journal is None:
+            sys.stderr.write("No restack in progress\n")
+            sys.exit(1)
+        if args.stack_cmd == "abort":
+            journal.abort()
+        else:
+            continue_restack(journal)
     elif args.stack_cmd == "prev":
         navigate_stack_relative(-1 * args.count)
     elif args.stack_cmd == "next":
@@ -893,37 +2877,47 @@ def cmd_stack(args, parser):
         navigate_stack_relative(-10000)
     elif args.stack_cmd == "reset_remote":
         exit_if_dirty()
-        cur = current_branch()
         stack = get_stack(current_stack(), required=True)
         unmerged = [
             child.branch for child in stack.unmerged_children() if child.local_exists
         ] + [stack.name]
+        if args.fetch:
+            fetch_branches(unmerged)
+        snapshot = refs()
+        targets = {}
         for branch in unmerged:
-            switch_branch(branch)
-            git("reset", "--hard", "origin/" + branch, check=False)
-        switch_branch(cur)
+            oid = snapshot.resolve("refs/remotes/origin/" + branch)
+            if oid is not None:
+                targets[branch] = oid
+        update_branches(targets, "githelper: reset_remote")
     elif args.stack_cmd == "delete":
         stack = get_stack(args.name, required=True)
         for child in stack.all_children():
             if child.local_exists:
                 delete_branch(child.branch, args.force)
+    elif args.stack_cmd == "status" and args.all:
+
+        def dashboard_stacks() -> List[Stack]:
+            return [s for s in list_stacks() if s.all_children() and s.has_tip]
+
+        stacks = dashboard_stacks()
+        if args.fetch:
+            fetch_branches([b for stack in stacks for b in stack.unmerged_branches()])
+            stacks = dashboard_stacks()
+        refresh_pr_cache(use_cache=True)
+        for i, stack in enumerate(stacks):
+            # Closed PRs that aren't cached would cost a query per stack
+            stack.attach_prs()
+            if i > 0:
+                print()
+            print_stack_status(stack)
     elif args.stack_cmd == "status":
         stack = get_stack(args.name, required=True)
-        stack.load_prs()
-        header = [stack.name]
-        if stack.needs_restack():
-            header.append("(needs restack)")
-        if stack.is_incomplete():
-            header.append("(has unstacked commits)")
-        print(" ".join(header))
-        for child in reversed(stack.all_children()):
-            line = [child.branch]
-            # TODO display origin status
-            if child.pull_request:
-                line.append(f"#{child.pull_request.number}")
-            if child.is_merged:
-                line.append(f"(merged)")
-            print(" ".join(line))
+        if args.fetch:
+            fetch_branches(stack.unmerged_branches())
+            stack = get_stack(args.name, required=True)
+        stack.load_prs(use_cache=True)
+        print_stack_status(stack)
     else:
         parser.print_help()
 
@@ -935,6 +2929,23 @@ def _add_cmd_update(parser):
         action="store_true",
         help="Rebase local branches, do not do a fetch",
     )
+    parser.add_argument(
+        "--no-maintain",
+        action="store_true",
+        help="Don't refresh the commit-graph and bitmaps afterwards",
+    )
+    parser.add_argument(
+        "--restack-all",
+        action="store_true",
+        help="Rebase every stack onto the updated main branch",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of stacks to restack in parallel",
+    )
 
 
 def cmd_update(args):
@@ -947,6 +2958,366 @@ def cmd_update(args):
         if branch.startswith(remote_main_branch()):
             git("rebase", "origin/" + branch, branch)
     switch_branch(cur)
+    if not args.no_maintain:
+        for name, reason in maintain().items():
+            print(f"Refreshed {name} ({reason})")
+    if args.restack_all:
+        failed = restack_all(args.jobs)
+        if failed:
+            sys.exit(1)
+
+
+def restack_all(jobs: int) -> List[str]:
+    """Rebase every stack onto the main branch and return the ones that failed
+
+    Stacks are rewritten in place by a pool of processes. Without merge-tree support they
+    are rebased one at a time in the worktree instead.
+    """
+    target = get_origin_master()
+    stacks = [
+        stack for stack in list_stacks() if stack.unmerged_children() and stack.has_tip
+    ]
+    if supports_merge_tree():
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs,
+            initializer=init_restack_worker,
+            initargs=(BACKEND, CACHE_ENABLED),
+        ) as executor:
+            errors = list(executor.map(restack_stack, stacks, [target] * len(stacks)))
+        # The workers moved refs behind this process's back
+        invalidate_refs()
+    else:
+        cur = current_branch()
+        errors = [restack_stack(stack, target, worktree=True) for stack in stacks]
+        switch_branch(cur)
+    failed = []
+    for stack, error in zip(stacks, errors):
+        if error is None:
+            print("Restacked", stack.name)
+        else:
+            print(f"Failed    {stack.name}: {error}")
+            failed.append(stack.name)
+    return failed
+
+
+def init_restack_worker(backend_name: str, cache_enabled: bool):
+    """Start a restack worker without any of the parent's state"""
+    global CACHE_ENABLED, _state_cache, _patch_id_index
+    CACHE_ENABLED = cache_enabled
+    reset_backend(backend_name)
+    _patch_id_index = None
+    # Read the cache, but leave saving it to the parent
+    _state_cache = None
+    state_cache().path = None
+
+
+def restack_stack(stack: Stack, target: str, worktree: bool = False) -> Optional[str]:
+    """Rebase a stack onto target, returning an error message if it failed"""
+    stack_refs(stack.name)
+    try:
+        journal = stack.plan_restack(target)
+    except (ValueError, subprocess.CalledProcessError) as e:
+        return f"could not plan the restack: {e}"
+    try:
+        if worktree:
+            journal.rebase()
+        else:
+            journal.replay()
+        journal.finish()
+    except MergeConflict as e:
+        return f"{e}, rebase it with 'stack rebase'"
+    except subprocess.CalledProcessError as e:
+        journal.abort()
+        return f"{' '.join(e.cmd)} failed"
+    return None
+
+
+def _add_cmd_hook(parser):
+    parser.add_argument(
+        "hook_cmd",
+        choices=["install", "uninstall"] + HOOKS,
+        help="Install or uninstall the hooks, or run one of them",
+    )
+    parser.add_argument("hook_args", nargs="*")
+
+
+def cmd_hook(args):
+    if args.hook_cmd == "install":
+        install_hooks()
+    elif args.hook_cmd == "uninstall":
+        uninstall_hooks()
+    elif args.hook_cmd == "post-rewrite":
+        hook_post_rewrite(sys.stdin.read().splitlines())
+    elif args.hook_cmd == "reference-transaction":
+        if args.hook_args[:1] == ["committed"]:
+            hook_reference_transaction(sys.stdin.read().splitlines())
+
+
+def hooks_dir() -> str:
+    return os.path.abspath(git("rev-parse", "--git-path", "hooks"))
+
+
+def install_hooks():
+    """Keep stack metadata up to date when branches are rewritten outside of githelper"""
+    hook_dir = hooks_dir()
+    for hook in HOOKS:
+        path = os.path.join(hook_dir, hook)
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as ifile:
+                if HOOK_MARKER not in ifile.read():
+                    sys.stderr.write(f"Not overwriting existing hook {path}\n")
+                    sys.exit(1)
+        lines = ["#!/bin/sh", HOOK_MARKER]
+        if hook == "reference-transaction":
+            lines.append('[ "$1" = committed ] || exit 0')
+        # githelper keeps its own metadata up to date
+        lines.append('[ -n "$GITHELPER_RUNNING" ] && exit 0')
+        lines.append(
+            f'exec "{sys.executable}" "{os.path.abspath(__file__)}" hook {hook} "$@"'
+        )
+        touch_file(path, "\n".join(lines) + "\n")
+        os.chmod(path, 0o755)
+        print("Installed", path)
+
+
+def uninstall_hooks():
+    hook_dir = hooks_dir()
+    for hook in HOOKS:
+        path = os.path.join(hook_dir, hook)
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as ifile:
+                if HOOK_MARKER in ifile.read():
+                    os.unlink(path)
+                    print("Removed", path)
+
+
+def hook_post_rewrite(lines: List[str]):
+    """Carry branch tags and child bases over to the commits that replaced them"""
+    rewrites = {}
+    for line in lines:
+        old, new = line.split()[:2]
+        rewrites[old] = new
+    if not rewrites:
+        return
+    read_commits(list(rewrites) + list(rewrites.values()))
+    cache = state_cache()
+    for old, new in rewrites.items():
+        tag = get_tag(old)
+        if tag is not None and get_tag(new) is None:
+            cache.set("tag", new, tag)
+
+    # A child's base only changes if the first commit on top of it was rewritten
+    snapshot = refs(complete=True)
+    bases = {}
+    for ref, base in snapshot.oids.items():
+        if not ref.startswith(BASE_REF_PREFIX):
+            continue
+        branch = ref[len(BASE_REF_PREFIX) :]
+        for old, new in rewrites.items():
+            if read_commits([old])[old].parents[:1] == [base] and get_tag(old) in (
+                None,
+                branch,
+            ):
+                bases[branch] = read_commits([new])[new].parents[0]
+                break
+    update_branches({}, "githelper: post-rewrite", bases=bases)
+
+
+def hook_reference_transaction(lines: List[str]):
+    """Drop the bases of deleted branches and check the stacks whose branches moved"""
+    branches = set()
+    deleted = []
+    for line in lines:
+        _, new, ref = line.split()
+        if not ref.startswith("refs/heads/"):
+            continue
+        branch = ref[len("refs/heads/") :]
+        branches.add(branch)
+        if new == ZERO_OID:
+            deleted.append(branch)
+    if not branches:
+        return
+    stale = []
+    if deleted:
+        bases = [BASE_REF_PREFIX + branch for branch in deleted]
+        stale = git_lines("for-each-ref", "--format=%(refname)", *bases)
+    if stale:
+        git(
+            "update-ref",
+            "--stdin",
+            input="".join(f"delete {ref}\n" for ref in stale).encode("utf-8"),
+        )
+    # The answers land in the state cache, so stack status doesn't have to walk history.
+    # Only the touched stacks are loaded, this runs on every ref update.
+    for name in {STACK_RE.sub(r"\1", branch) for branch in branches}:
+        # This only warms the cache, so it must never fail the git command that ran it
+        try:
+            stack = get_stack(name)
+            if stack is not None and stack.has_tip:
+                stack.needs_restack()
+                stack.is_incomplete()
+        except Exception:
+            pass
+
+
+def _add_cmd_maintain(parser):
+    parser.add_argument(
+        "-f",
+        "--force",
+        action="store_true",
+        help="Rewrite the commit-graph and bitmaps from scratch",
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="Only report what is out of date, exiting non-zero if anything is",
+    )
+
+
+def cmd_maintain(args):
+    if args.check:
+        stale = stale_maintenance()
+        for name, reason in stale.items():
+            print(f"{name}: {reason}")
+        if stale:
+            sys.exit(1)
+        print("Up to date")
+        return
+    refreshed = maintain(args.force)
+    for name, reason in refreshed.items():
+        print(f"Refreshed {name} ({reason})")
+    if not refreshed:
+        print("Up to date")
+
+
+def objects_dir() -> str:
+    return os.path.abspath(git("rev-parse", "--git-path", "objects"))
+
+
+def commit_graph_files() -> List[str]:
+    info = os.path.join(objects_dir(), "info")
+    chain = os.path.join(info, "commit-graphs", "commit-graph-chain")
+    if os.path.exists(chain):
+        with open(chain, "r", encoding="utf-8") as ifile:
+            return [
+                os.path.join(info, "commit-graphs", f"graph-{layer}.graph")
+                for layer in ifile.read().split()
+            ]
+    single = os.path.join(info, "commit-graph")
+    return [single] if os.path.exists(single) else []
+
+
+def commit_graph_chunks(path: str) -> Set[str]:
+    """Ids of the chunks in a commit-graph file, read from its table of contents"""
+    with open(path, "rb") as ifile:
+        header = ifile.read(8)
+        if len(header) < 8 or header[:4] != b"CGPH":
+            return set()
+        num_chunks = header[6]
+        toc = ifile.read(12 * num_chunks)
+    return {toc[i : i + 4].decode("ascii", "replace") for i in range(0, len(toc), 12)}
+
+
+def commit_graph_complete(files: List[str]) -> bool:
+    """If every layer has generation numbers and changed-path Bloom filters"""
+    for path in files:
+        chunks = commit_graph_chunks(path)
+        # Generation data was GDAT before git 2.36
+        if "BDAT" not in chunks or not chunks & {"GDA2", "GDAT"}:
+            return False
+    return True
+
+
+def pack_names() -> List[str]:
+    pack_dir = os.path.join(objects_dir(), "pack")
+    return sorted(name for name in os.listdir(pack_dir) if name.endswith(".pack"))
+
+
+def has_bitmaps() -> bool:
+    pack_dir = os.path.join(objects_dir(), "pack")
+    return any(name.endswith(".bitmap") for name in os.listdir(pack_dir))
+
+
+def loose_objects() -> int:
+    for line in git_lines("count-objects", "-v"):
+        key, value = line.split(":", 1)
+        if key == "count":
+            return int(value)
+    return 0
+
+
+def maintenance_state_path() -> str:
+    return githelper_path("maintain.json")
+
+
+def load_maintenance_state() -> Dict[str, List[str]]:
+    """The ref tips and packs that the commit-graph and bitmaps were last written for"""
+    path = maintenance_state_path()
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as ifile:
+            return json.load(ifile)
+    except ValueError:
+        return {}
+
+
+def stale_maintenance() -> Dict[str, str]:
+    """The maintenance files that are missing or out of date, and why"""
+    state = load_maintenance_state()
+    stale = {}
+    graphs = commit_graph_files()
+    if not graphs:
+        stale["commit-graph"] = "missing"
+    elif not commit_graph_complete(graphs):
+        stale["commit-graph"] = "no generation numbers or changed-path filters"
+    else:
+        tips = set(refs(complete=True).oids.values()) - set(state.get("tips", []))
+        if tips:
+            stale["commit-graph"] = f"{len(tips)} new ref tips"
+    if not has_bitmaps():
+        stale["bitmaps"] = "missing"
+    else:
+        packs = set(pack_names()) - set(state.get("packs", []))
+        loose = loose_objects()
+        if packs:
+            stale["bitmaps"] = f"{len(packs)} new packs"
+        elif loose >= MAINTAIN_LOOSE_OBJECTS:
+            stale["bitmaps"] = f"{loose} loose objects"
+    return stale
+
+
+@traced
+def maintain(force: bool = False) -> Dict[str, str]:
+    """Bring the commit-graph and reachability bitmaps up to date
+
+    Only what is stale is refreshed, and incrementally where git allows it. Returns what
+    was refreshed and why.
+    """
+    if force:
+        stale = {"commit-graph": "forced", "bitmaps": "forced"}
+    else:
+        stale = stale_maintenance()
+    if not stale:
+        return stale
+    state = load_maintenance_state()
+    if "bitmaps" in stale:
+        # A multi-pack bitmap covers new packs without rewriting the existing ones
+        if force or not has_bitmaps() or git_version() < (2, 34):
+            git("repack", "-a", "-d", "-q", "--write-bitmap-index")
+        else:
+            git("repack", "-d", "-q", "--write-midx", "--write-bitmap-index")
+        state["packs"] = pack_names()
+    if "commit-graph" in stale:
+        tips = sorted(set(refs(complete=True).oids.values()))
+        # Layers without the newer chunks have to be rewritten rather than extended
+        split = "--split"
+        if force or not commit_graph_complete(commit_graph_files()):
+            split = "--split=replace"
+        git("commit-graph", "write", "--reachable", "--changed-paths", split)
+        state["tips"] = tips
+    atomic_write(maintenance_state_path(), json.dumps(state))
+    return stale
 
 
 def _add_cmd_test(parser):
@@ -960,7 +3331,27 @@ def _add_cmd_test(parser):
             "reset",
             "old_stack",
             "incomplete_stack",
+            "load_prs",
+            "update_prs",
+            "create_prs",
+            "backends",
+            "base_index",
+            "hooks",
+            "squash_merge",
+            "stack_lookup",
+            "restack_all",
+            "restack_journal",
+            "maintain",
+            "status_tracking",
+            "status_all",
+            "create_stack",
+            "reused_branches",
+            "state_cache",
+            "ref_snapshot",
+            "commit_graph",
+            "merge_tree_restack",
         ],
+        help=f"Scenario to run. Exits {TEST_SKIPPED} when this git can't run it.",
     )
 
 
@@ -1008,13 +3399,1395 @@ def cmd_test(args):
         make_stack()
         git("commit", "--allow-empty", "-m", "Test commit 3")
         git("commit", "--allow-empty", "-m", "Test commit 4")
+    elif args.test_cmd == "load_prs":
+        test_load_prs()
+    elif args.test_cmd == "update_prs":
+        test_update_prs()
+    elif args.test_cmd == "create_prs":
+        test_create_prs()
+    elif args.test_cmd == "backends":
+        test_backends()
+    elif args.test_cmd == "base_index":
+        test_base_index()
+    elif args.test_cmd == "hooks":
+        test_hooks()
+    elif args.test_cmd == "squash_merge":
+        test_squash_merge()
+    elif args.test_cmd == "stack_lookup":
+        test_stack_lookup()
+    elif args.test_cmd == "restack_all":
+        test_restack_all()
+    elif args.test_cmd == "restack_journal":
+        test_restack_journal()
+    elif args.test_cmd == "maintain":
+        test_maintain()
+    elif args.test_cmd == "status_tracking":
+        test_status_tracking()
+    elif args.test_cmd == "status_all":
+        test_status_all()
+    elif args.test_cmd == "create_stack":
+        test_create_stack()
+    elif args.test_cmd == "reused_branches":
+        test_reused_branches()
+    elif args.test_cmd == "state_cache":
+        test_state_cache()
+    elif args.test_cmd == "ref_snapshot":
+        test_ref_snapshot()
+    elif args.test_cmd == "commit_graph":
+        test_commit_graph()
+    elif args.test_cmd == "merge_tree_restack":
+        test_merge_tree_restack()
     else:
         print(f"Unknown test command {args.test_cmd}")
 
 
+def make_test_repo(root: str) -> str:
+    """Create a clone of a local bare repo with one commit on the main branch"""
+    origin = os.path.join(root, "origin.git")
+    repo = os.path.join(root, "repo")
+    git("init", "-q", "--bare", "-b", "main", origin)
+    git("clone", "-q", origin, repo)
+    os.chdir(repo)
+    git("config", "user.name", USER)
+    git("config", "user.email", f"{USER}@localhost")
+    git("commit", "--allow-empty", "-m", "Initial commit")
+    git("push", "-q", "-u", "origin", "main")
+    git("remote", "set-head", "origin", "main")
+    remote_main_branch.cache_clear()
+    return repo
+
+
+def install_fake_gh(root: str, prs: List[Dict[str, Any]], latency: float = 0) -> str:
+    """Put a stand-in gh executable that serves PRs from a local state file on the PATH"""
+    bin_dir = os.path.join(root, "bin")
+    os.makedirs(bin_dir, exist_ok=True)
+    state_file = os.path.join(root, "gh_state.json")
+    with open(state_file, "w", encoding="utf-8") as ofile:
+        json.dump({"prs": prs, "calls": []}, ofile)
+    gh_bin = os.path.join(bin_dir, "gh")
+    touch_file(
+        gh_bin,
+        f'#!/bin/sh\nexec "{sys.executable}" "{os.path.abspath(__file__)}" fake-gh "$@"\n',
+    )
+    os.chmod(gh_bin, 0o755)
+    os.environ["PATH"] = bin_dir + os.pathsep + os.environ["PATH"]
+    os.environ["GITHELPER_FAKE_GH_STATE"] = state_file
+    os.environ["GITHELPER_FAKE_GH_LATENCY"] = str(latency)
+    return state_file
+
+
+# Exit status of a test that can't run here, the automake convention
+TEST_SKIPPED = 77
+
+
+@contextlib.contextmanager
+def capture_trace() -> Iterator[Tracer]:
+    """Trace the calls made inside the block, for a test to assert on"""
+    global _tracer
+    _tracer = Tracer(os.devnull)
+    try:
+        yield _tracer
+    finally:
+        _tracer = None
+
+
+def commit_test_file(path: str, contents: str, *messages: str):
+    touch_file(path, contents)
+    git("add", path)
+    git("commit", "-q", *[arg for message in messages for arg in ["-m", message]])
+
+
+def make_test_children(
+    name: str,
+    num_children: int,
+    files: bool = False,
+    commits: int = 1,
+    conflict: Optional[int] = None,
+):
+    """Commit children onto the current branch, tagged the way make_stack leaves them
+
+    With files, each commit adds its own file, except that child number conflict edits
+    a shared "conflict" file. Otherwise the commits are empty.
+    """
+    for i in range(1, num_children + 1):
+        for j in range(1, commits + 1):
+            message = f"Commit {i}" if commits == 1 else f"Commit {i}.{j}"
+            trailer = f"branch: {name}-{i}"
+            if not files:
+                git("commit", "-q", "--allow-empty", "-m", message, "-m", trailer)
+            elif i == conflict:
+                commit_test_file("conflict", f"{name} {message}\n", message, trailer)
+            else:
+                path = f"{name}-{i}.txt" if commits == 1 else f"{name}-{i}.{j}.txt"
+                commit_test_file(path, f"{name} {message}\n", message, trailer)
+        git("branch", f"{name}-{i}")
+
+
+def fake_gh_calls(state_file: str) -> List[List[str]]:
+    with open(state_file, "r", encoding="utf-8") as ifile:
+        return json.load(ifile)["calls"]
+
+
+def make_test_stack(
+    root: str,
+    num_children: int,
+    latency: float = 0,
+    num_merged: int = 0,
+    with_prs: bool = True,
+    files: bool = False,
+    commits: int = 1,
+    conflict: Optional[int] = None,
+) -> Tuple[Stack, str]:
+    """Create a stack with a PR for every child, served by a fake gh"""
+    make_test_repo(root)
+    create_branch("stack", "main")
+    make_test_children("stack", num_children, files, commits, conflict)
+    table = make_markdown_table(
+        [
+            {"": str(i), "PR": f"#{100 + i}", "Title": f"Commit {i}"}
+            for i in range(1, num_children + 1)
+        ],
+        ["", "PR", "Title"],
+    )
+    prs = []
+    for i in range(1, num_children + 1 if with_prs else 1):
+        prs.append(
+            {
+                "id": f"PR_{100 + i}",
+                "number": 100 + i,
+                "title": f"[{i}/{num_children}] Commit {i}",
+                "body": table + "\n",
+                "url": f"https://github.com/{USER}/test/pull/{100 + i}",
+                "isDraft": False,
+                "headRefName": f"stack-{i}",
+                "state": "MERGED" if i <= num_merged else "OPEN",
+            }
+        )
+    state_file = install_fake_gh(root, prs, latency)
+    invalidate_refs()
+    return get_stack("stack", required=True), state_file
+
+
+def test_load_prs():
+    with tempfile.TemporaryDirectory() as root:
+        # Only the last PR is open, but one listing of every state finds the merged ones
+        stack, state_file = make_test_stack(root, 8, latency=0.2, num_merged=7)
+
+        start = time.perf_counter()
+        stack.load_prs()
+        elapsed = time.perf_counter() - start
+
+        found = [
+            child.pull_request.number
+            for child in stack.all_children()
+            if child.pull_request
+        ]
+        calls = fake_gh_calls(state_file)
+        print(f"Loaded {len(found)} PRs with {len(calls)} gh calls in {elapsed:.2f}s")
+        assert found == list(range(101, 109)), found
+        # An empty cache is filled by a single listing of PRs in every state
+        assert [call[:2] for call in calls] == [["pr", "list"]], calls
+
+        # Only the PR that changed on GitHub is fetched again
+        with open(state_file, "r", encoding="utf-8") as ifile:
+            state = json.load(ifile)
+        state["prs"][7]["title"] = "[8/8] Renamed"
+        state["prs"][7]["updatedAt"] = "2024-02-01T00:00:00Z"
+        with open(state_file, "w", encoding="utf-8") as ofile:
+            json.dump(state, ofile)
+        stack.load_prs()
+        calls = fake_gh_calls(state_file)[1:]
+        assert [call[:2] for call in calls] == [["pr", "list"], ["api", "graphql"]]
+        assert "pullRequest(number: 108)" in calls[1][-1], calls
+        assert "pullRequest(number: 107)" not in calls[1][-1], calls
+        assert stack.all_children()[-1].pull_request.title == "Renamed"
+
+        # Within the TTL, or offline, status doesn't call gh at all
+        global OFFLINE, _pr_cache
+        stack.load_prs(use_cache=True)
+        # Read back what was saved to disk
+        pr_cache().save()
+        _pr_cache = None
+        OFFLINE = True
+        stack.load_prs()
+        OFFLINE = False
+        assert len(fake_gh_calls(state_file)) == 3
+        found = [c.pull_request.number for c in stack.all_children() if c.pull_request]
+        assert found == list(range(101, 109)), found
+
+
+def test_reused_branches():
+    with tempfile.TemporaryDirectory() as root:
+        # A new stack that reuses the branch names of one that was merged
+        stack, state_file = make_test_stack(root, 3, num_merged=3)
+        stack.load_prs()
+        assert not any(child.pull_request for child in stack.all_children())
+        created = stack.create_prs()
+        assert len(created) == 3, created
+        calls = fake_gh_calls(state_file)
+        assert not [call for call in calls if "mutation" in call[-1]], calls
+        print("Merged PRs of reused branch names were left alone")
+
+
+def test_update_prs():
+    num_children = 12
+    with tempfile.TemporaryDirectory() as root:
+        stack, state_file = make_test_stack(root, num_children, latency=0.2)
+        stack.load_prs()
+        # Add a new child to the stack so every title and table is out of date
+        new_child = stack.create_next_child()
+        new_child.pull_request = PullRequest(
+            200, "New commit", "", "https://example.com", True, "PR_200"
+        )
+        stack.add_child(new_child)
+        with open(state_file, "r+", encoding="utf-8") as state_io:
+            state = json.load(state_io)
+            state["prs"].append(
+                {
+                    "id": "PR_200",
+                    "number": 200,
+                    "title": "New commit",
+                    "body": "",
+                    "url": "https://example.com",
+                    "isDraft": True,
+                    "headRefName": new_child.branch,
+                    "state": "OPEN",
+                }
+            )
+            state_io.seek(0)
+            json.dump(state, state_io)
+
+        start = time.perf_counter()
+        updated = stack.update_prs()
+        for child in stack.unmerged_children():
+            assert child.pull_request
+            child.pull_request.set_draft(False)
+        published = stack.update_prs()
+        elapsed = time.perf_counter() - start
+
+        calls = fake_gh_calls(state_file)[1:]
+        print(
+            f"Updated {len(updated)} PRs with {len(calls)} gh calls in {elapsed:.2f}s"
+        )
+        assert len(updated) == num_children + 1, updated
+        # Publishing changes the table row in every PR
+        assert len(published) == num_children + 1, published
+        assert [call[:2] for call in calls] == [["api", "graphql"]] * 2, calls
+        with open(state_file, "r", encoding="utf-8") as ifile:
+            state = json.load(ifile)
+        for i, pr in enumerate(state["prs"]):
+            assert pr["title"].startswith(f"[{i + 1}/{num_children + 1}] "), pr
+            assert not pr["isDraft"], pr
+            assert f">{pr['number']}" in pr["body"], pr
+
+
+def test_create_prs():
+    num_children = 10
+    latency = 1.0
+    with tempfile.TemporaryDirectory() as root:
+        stack, state_file = make_test_stack(
+            root, num_children, latency=latency, with_prs=False
+        )
+        start = time.perf_counter()
+        created = stack.create_prs(jobs=4)
+        elapsed = time.perf_counter() - start
+
+        calls = fake_gh_calls(state_file)
+        print(
+            f"Created {len(created)} PRs with {len(calls)} gh calls in {elapsed:.2f}s"
+        )
+        assert len(created) == num_children, created
+        assert all(call[0] == "api" for call in calls), calls
+        # Creating the PRs one at a time could not beat the sum of the latencies
+        assert elapsed < num_children * latency, elapsed
+        base = "main"
+        for i, child in enumerate(stack.all_children()):
+            pr = child.pull_request
+            assert pr and pr.is_draft and pr.title == f"Commit {i + 1}", pr
+            with open(state_file, "r", encoding="utf-8") as ifile:
+                pr_state = fake_gh_handle(
+                    json.load(ifile), ["pr", "view", pr.url, "--json", "baseRefName"]
+                )
+            assert pr_state["baseRefName"] == base, pr_state
+            base = child.branch
+
+
+def test_base_index():
+    num_children = 5
+    with tempfile.TemporaryDirectory() as root:
+        stack, _ = make_test_stack(root, num_children, with_prs=False)
+        branches = [child.branch for child in stack.all_children()]
+        for worktree in [False, True]:
+            # Amend a child in the middle, which leaves the ones after it behind
+            switch_branch(branches[1])
+            git("commit", "-q", "--amend", "--allow-empty", "-m", f"Amended {worktree}")
+            switch_branch("stack")
+            stack = get_stack("stack", required=True)
+            stack.rebase(worktree=worktree)
+            stack = get_stack("stack", required=True)
+            assert not stack.needs_restack()
+            snapshot = refs()
+            prev = merge_base(branches[0])
+            for branch in branches:
+                base = snapshot.resolve(BASE_REF_PREFIX + branch)
+                assert base == prev, (branch, base, prev)
+                assert _find_branch_parent(prev, branch) == base, branch
+                prev = rev_parse(branch)
+        # A branch rewritten behind githelper's back falls back to the trailers
+        switch_branch(branches[0])
+        git("commit", "-q", "--allow-empty", "-m", "Unstacked", "-m", "branch: stack-1")
+        git("rebase", "-q", "--onto", branches[0], branches[0] + "^", branches[1])
+        assert find_branch_parent(branches[0], branches[1]) == rev_parse(branches[0])
+        print(f"Base index matches the trailers for {num_children} children")
+
+
+def test_hooks():
+    global _state_cache
+    with tempfile.TemporaryDirectory() as root:
+        stack, _ = make_test_stack(root, 4, with_prs=False)
+        stack.rebase()
+        install_hooks()
+        # Act like the user running git by hand, so the hooks fire
+        del os.environ["GITHELPER_RUNNING"]
+
+        switch_branch("stack-2")
+        git("commit", "-q", "--amend", "--allow-empty", "-m", "Reworded")
+        # The hooks save what they learn to the state cache on disk
+        _state_cache = None
+        invalidate_refs()
+        assert get_tag("stack-2") == "stack-2"
+        key = rev_parse("stack-2") + ":" + rev_parse("stack-3")
+        assert state_cache().get("ancestry", key) is False, key
+
+        # Rebase the first child by hand onto a newer main
+        switch_branch("main")
+        git("commit", "-q", "--allow-empty", "-m", "Main moved")
+        git("push", "-q", "origin", "main")
+        git("rebase", "-q", "origin/main", "stack-1")
+        invalidate_refs()
+        assert refs().resolve(BASE_REF_PREFIX + "stack-1") == rev_parse("origin/main")
+
+        git("branch", "-q", "-D", "stack-4")
+        invalidate_refs()
+        assert refs().resolve(BASE_REF_PREFIX + "stack-4") is None
+
+        # A plain branch named like a child belongs to a stack without a tip branch
+        create_branch("bug-12", "main")
+        proc = run_process(
+            ["git", "commit", "--allow-empty", "-m", "Fix bug"], capture_output=True
+        )
+        assert proc.returncode == 0 and b"Traceback" not in proc.stderr, proc.stderr
+        # A ref update only loads the refs of the stack it touched
+        invalidate_refs()
+        oid = rev_parse("stack-1")
+        hook_reference_transaction([f"{oid} {oid} refs/heads/stack-1"])
+        assert refs().partial
+
+        os.environ["GITHELPER_RUNNING"] = "1"
+        uninstall_hooks()
+        assert not any(os.path.exists(os.path.join(hooks_dir(), h)) for h in HOOKS)
+        print("Hooks kept tags and bases up to date")
+
+
+def test_squash_merge():
+    global SQUASH_SCAN_DEPTH, _patch_id_index
+    with tempfile.TemporaryDirectory() as root:
+        # A squash merge combines the commits of a child, a rebase merge keeps them
+        make_test_stack(root, 3, with_prs=False, files=True, commits=2)
+        switch_branch("main")
+        git("merge", "-q", "--squash", "stack-1")
+        git("commit", "-q", "-m", "Squash-merge stack-1")
+        git("merge", "-q", "--squash", "stack-2")
+        git("commit", "-q", "-m", "Squash-merge stack-2")
+        git("push", "-q", "origin", "main")
+        switch_branch("stack")
+
+        stack = get_stack("stack", required=True)
+        merged = [child.branch for child in stack.all_children() if child.is_merged]
+        assert merged == ["stack-1", "stack-2"], merged
+
+        # Unrelated work on main only extends the index, the children aren't diffed again
+        switch_branch("main")
+        commit_test_file("other", "other\n", "Add other")
+        git("push", "-q", "origin", "main")
+        switch_branch("stack")
+        invalidate_refs()
+        with capture_trace() as trace:
+            stack = get_stack("stack", required=True)
+        assert "git diff-tree" not in trace.names("process"), trace.names("process")
+        merged = [child.branch for child in stack.all_children() if child.is_merged]
+        assert merged == ["stack-1", "stack-2"], merged
+        # Rebasing onto main drops the children that already landed
+        stack.rebase("origin/main")
+        subjects = git_lines("log", "--format=%s", "origin/main..stack")
+        assert subjects == ["Commit 3.2", "Commit 3.1"], subjects
+
+        switch_branch("main")
+        git("cherry-pick", "origin/main..stack-3")
+        git("push", "-q", "origin", "main")
+        switch_branch("stack")
+        invalidate_refs()
+        stack = get_stack("stack", required=True)
+        assert stack.all_children()[-1].is_merged
+        index = patch_id_index()
+        assert index.tip == rev_parse("origin/main"), index.tip
+        num_ids = len(index.ids)
+        cmd_stack(argparse.Namespace(stack_cmd="clean", name="stack"), None)
+        invalidate_refs()
+        assert not {"stack-1", "stack-2", "stack-3"} & set(list_branches())
+
+        # A child that forked long ago doesn't widen the scan past the depth limit
+        SQUASH_SCAN_DEPTH = 2
+        _patch_id_index = PatchIdIndex(None)
+        create_branch("old-1", "origin/main~4")
+        git("commit", "-q", "--allow-empty", "-m", "Old", "-m", "branch: old-1")
+        invalidate_refs()
+        list_stacks()
+        assert patch_id_index().start == rev_parse("origin/main~2")
+        print(f"Found squash merges with {num_ids} indexed patch ids")
+
+
+def test_stack_lookup():
+    with tempfile.TemporaryDirectory() as root:
+        make_test_stack(root, 4, with_prs=False)
+        # Branches whose names share a prefix with the stack
+        for branch in ["stack-other", "stack-other-1", "stacked", "stack-2-fix"]:
+            git("branch", branch, "stack-2")
+        git("push", "-q", "origin", "stack-1", "stack-3")
+        git("branch", "-q", "-D", "stack-1")
+
+        def describe(stack: Stack) -> List[Tuple[str, bool, bool]]:
+            return [
+                (c.branch, c.is_merged, c.local_exists) for c in stack.all_children()
+            ]
+
+        invalidate_refs()
+        expected = next(s for s in list_stacks() if s.name == "stack")
+        for name in [".", "stack"]:
+            reset_backend(BACKEND)
+            stack = get_stack(name, required=True)
+            assert refs().partial
+            assert describe(stack) == describe(expected), describe(stack)
+            assert stack.needs_restack() == expected.needs_restack()
+        # Asking for every branch replaces the partial snapshot
+        assert "stacked" in list_branches() and not refs().partial
+        print("Single stack lookup matches list_stacks")
+
+
+def test_restack_all():
+    with tempfile.TemporaryDirectory() as root:
+        make_test_repo(root)
+        for name in ["one", "two", "conflict"]:
+            create_branch(name, "main")
+            make_test_children(
+                name, 2, files=True, conflict=1 if name == "conflict" else None
+            )
+        switch_branch("main")
+        commit_test_file("conflict", "main\n", "Main moved")
+        git("push", "-q", "origin", "main")
+        git("branch", "bug-1234", "main")
+        before = rev_parse("conflict")
+
+        failed = restack_all(2)
+        assert failed == ["conflict"], failed
+        assert rev_parse("conflict") == before
+        bug = next(stack for stack in list_stacks() if stack.name == "bug")
+        assert restack_stack(bug, "origin/main") is not None
+        assert not os.path.exists(os.path.join(git_common_dir(), "rebase-merge"))
+        main = rev_parse("origin/main")
+        for name in ["one", "two"]:
+            stack = get_stack(name, required=True)
+            assert not stack.needs_restack(), name
+            assert merge_base(name + "-1") == main, name
+        print("Restacked all stacks but the one with a conflict")
+
+
+def test_restack_journal():
+    with tempfile.TemporaryDirectory() as root:
+        make_test_stack(root, 3, with_prs=False, files=True, conflict=2)
+        switch_branch("main")
+        commit_test_file("conflict", "main\n", "Main moved")
+        git("push", "-q", "origin", "main")
+        switch_branch("stack")
+        branches = ["stack-1", "stack-2", "stack-3", "stack"]
+        heads = {branch: rev_parse(branch) for branch in branches}
+
+        def rebase_until_conflict() -> RestackJournal:
+            try:
+                get_stack("stack", required=True).rebase("origin/main")
+            except SystemExit:
+                pass
+            journal = RestackJournal.load()
+            assert journal is not None
+            assert journal.steps[0]["new"] is not None
+            assert journal.steps[1]["new"] is None
+            return journal
+
+        rebase_until_conflict().abort()
+        assert RestackJournal.load() is None
+        assert not rebase_in_progress()
+        assert {branch: rev_parse(branch) for branch in branches} == heads
+        assert current_branch() == "stack"
+
+        journal = rebase_until_conflict()
+        first = journal.steps[0]["new"]
+        touch_file("conflict", "resolved\n")
+        git("add", "conflict")
+        continue_restack(journal)
+        # The child before the conflict was not rebased again
+        assert rev_parse("stack-1") == first
+        assert RestackJournal.load() is None
+        assert current_branch() == "stack"
+        stack = get_stack("stack", required=True)
+        assert not stack.needs_restack()
+        assert merge_base("stack-1") == rev_parse("origin/main")
+
+        lock_path = githelper_path("lock")
+        holder = subprocess.Popen(
+            [
+                sys.executable,
+                "-c",
+                "import fcntl, sys, time\n"
+                "f = open(sys.argv[1], 'w')\n"
+                "fcntl.flock(f, fcntl.LOCK_EX)\n"
+                "print('locked', flush=True)\n"
+                "time.sleep(1)\n",
+                lock_path,
+            ],
+            stdout=subprocess.PIPE,
+        )
+        assert holder.stdout is not None
+        holder.stdout.readline()
+        start = time.perf_counter()
+        with repo_lock():
+            waited = time.perf_counter() - start
+        holder.wait()
+        assert waited > 0.5, waited
+        print(
+            f"Resumed a restack at the conflict and queued {waited:.1f}s for the lock"
+        )
+
+
+def test_maintain():
+    with tempfile.TemporaryDirectory() as root:
+        stack, _ = make_test_stack(root, 3, with_prs=False)
+        assert stale_maintenance() == {"commit-graph": "missing", "bitmaps": "missing"}
+        maintain()
+        assert stale_maintenance() == {}
+        assert commit_graph_complete(commit_graph_files())
+
+        # New commits only need a new commit-graph layer
+        git("commit", "-q", "--allow-empty", "-m", "Unstacked")
+        invalidate_refs()
+        assert stale_maintenance() == {"commit-graph": "1 new ref tips"}
+        layers = commit_graph_files()
+        assert maintain() == {"commit-graph": "1 new ref tips"}
+        assert set(layers) <= set(commit_graph_files())
+
+        # A pack that isn't in the bitmap yet, like one that a fetch leaves behind
+        git("repack", "-d", "-q")
+        assert stale_maintenance() == {"bitmaps": "1 new packs"}
+        maintain()
+        assert stale_maintenance() == {}
+        print(f"Refreshed {len(commit_graph_files())} commit-graph layers and bitmaps")
+
+
+def test_status_tracking():
+    with tempfile.TemporaryDirectory() as root:
+        stack, _ = make_test_stack(root, 4, with_prs=False)
+        push_branches([child.branch for child in stack.all_children()])
+        switch_branch("stack-1")
+        git("commit", "-q", "--allow-empty", "-m", "Local fix")
+        # Another machine pushes to stack-2, and stack-4 is deleted on origin
+        pushed = git(
+            "commit-tree", "-p", "stack-2", "-m", "Remote fix", "stack-2^{tree}"
+        )
+        # Pushing by path leaves origin/stack-2 alone
+        git(
+            "push",
+            "-q",
+            os.path.join("..", "origin.git"),
+            pushed + ":refs/heads/stack-2",
+        )
+        git("push", "-q", "origin", ":stack-4")
+        # Pushed without -u, so only origin/stack-3 tells where it is
+        git("branch", "-q", "--unset-upstream", "stack-3")
+        switch_branch("stack-3")
+        git("commit", "-q", "--allow-empty", "-m", "Unpushed fix")
+        switch_branch("stack")
+        invalidate_refs()
+        expected = {
+            "stack-1": "(ahead 1)",
+            "stack-2": "",
+            "stack-3": "(no upstream, ahead 1)",
+            "stack-4": "(upstream gone)",
+            "stack": "(not pushed)",
+        }
+        assert {branch: tracking_status(branch) for branch in expected} == expected
+
+        start = len(git_lines("reflog", "refs/remotes/origin/stack-2"))
+        fetch_branches(stack.unmerged_branches())
+        expected["stack-2"] = "(behind 1)"
+        assert {branch: tracking_status(branch) for branch in expected} == expected
+        # Only the stack's own refs were fetched
+        assert len(git_lines("reflog", "refs/remotes/origin/stack-2")) == start + 1
+        assert refs().resolve("refs/remotes/origin/main") == rev_parse("main")
+        print(f"Tracking status for {len(expected)} branches from one for-each-ref")
+
+
+def test_status_all():
+    with tempfile.TemporaryDirectory() as root:
+        _, state_file = make_test_stack(root, 3, num_merged=1)
+        with open(state_file, "r", encoding="utf-8") as ifile:
+            prs = json.load(ifile)["prs"]
+        # A second stack with a draft PR for its first child only
+        create_branch("other", "main")
+        for i in range(1, 3):
+            git(
+                "commit",
+                "-q",
+                "--allow-empty",
+                "-m",
+                f"Other {i}",
+                "-m",
+                f"branch: other-{i}",
+            )
+            git("branch", f"other-{i}")
+        # A plain branch named like a child, of a stack "bug" that has no tip branch
+        create_branch("bug-1234", "main")
+        git("commit", "-q", "--allow-empty", "-m", "Fix bug")
+        prs.append(
+            {
+                "id": "PR_200",
+                "number": 200,
+                "title": "[1/2] Other 1",
+                "body": "",
+                "url": f"https://github.com/{USER}/test/pull/200",
+                "isDraft": True,
+                "headRefName": "other-1",
+                "state": "OPEN",
+            }
+        )
+        state_file = install_fake_gh(root, prs)
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "stack", "status", "--all"],
+            capture_output=True,
+            check=True,
+        ).stdout.decode("utf-8")
+        expected = [
+            "other (not pushed)",
+            "other-2 (not pushed)",
+            "other-1 #200 (draft) (not pushed)",
+            "",
+            "stack (not pushed)",
+            "stack-3 #103 (not pushed)",
+            "stack-2 #102 (not pushed)",
+            "stack-1 #101 (merged)",
+        ]
+        assert output.splitlines() == expected, output
+        calls = fake_gh_calls(state_file)
+        assert [call[:2] for call in calls] == [["pr", "list"]], calls
+        invalidate_refs()
+        bug = get_stack("bug", required=True)
+        assert not bug.has_tip and bug.unmerged_branches() == ["bug-1234"]
+        assert not bug.needs_restack() and not bug.is_incomplete()
+        print(f"Showed {len(prs)} PRs across 2 stacks with {len(calls)} gh call")
+
+
+def test_create_stack():
+    num_commits = 25
+    with tempfile.TemporaryDirectory() as root:
+        make_test_repo(root)
+        create_branch("big", "main")
+
+        def add_commits(start: int, end: int):
+            for i in range(start, end):
+                commit_test_file(f"file{i}.txt", f"{i}\n", f"Commit {i}")
+
+        add_commits(0, num_commits)
+        tree = get_tree(rev_parse("big"))
+        with capture_trace() as trace:
+            start = time.perf_counter()
+            make_stack("big")
+            elapsed = time.perf_counter() - start
+        processes = trace.names("process")
+        assert processes.count("git update-ref") == 1, processes
+        assert not {"git checkout", "git read-tree", "git rebase"} & set(processes)
+        assert git("status", "--porcelain") == ""
+
+        def check_stack(num_children: int) -> List[str]:
+            stack = get_stack("big", required=True)
+            branches = [child.branch for child in stack.all_children()]
+            assert branches == [f"big-{i}" for i in range(1, num_children + 1)]
+            assert not stack.needs_restack()
+            assert rev_parse("big") == rev_parse(branches[-1])
+            prev = rev_parse("main")
+            for branch in branches:
+                assert get_tag(branch) == branch, branch
+                assert refs().resolve(BASE_REF_PREFIX + branch) == prev, branch
+                prev = rev_parse(branch)
+            return [rev_parse(branch) for branch in branches]
+
+        heads = check_stack(num_commits)
+        assert get_tree(rev_parse("big")) == tree
+
+        # Extending the stack leaves the existing children alone
+        add_commits(num_commits, num_commits + 2)
+        make_stack("big")
+        assert check_stack(num_commits + 2)[:num_commits] == heads
+        print(f"Created {num_commits} children with one update-ref in {elapsed:.2f}s")
+
+
+def backend_results() -> Dict[str, Any]:
+    """Everything the stack logic reads from the repository, through the current backend"""
+    be = backend()
+    main_oid = rev_parse("origin/main")
+    heads = {branch: rev_parse(branch) for branch in list_branches()}
+    tips = sorted(set(heads.values()))
+    stacks = list_stacks()
+    info = read_commits([heads["stack-3"]])[heads["stack-3"]]
+    rewritten = CommitInfo(
+        "", info.tree, [heads["stack-1"]], info.author, info.committer, "Rewritten\n"
+    )
+    return {
+        "refs": be.list_refs(["refs/heads", "refs/remotes"]),
+        "head": be.head_branch(),
+        "merged": sorted(be.merged(heads["stack-1"], ["refs/heads", "refs/remotes"])),
+        "merge_base": be.merge_base("stack-4", "other"),
+        "is_ancestor": [be.is_ancestor(a, b) for a in tips for b in tips if a != b],
+        "ahead_behind": be.ahead_behind(heads["stack-4"], heads["other"]),
+        "rev_list": be.rev_list(tips, main_oid),
+        "resolve": be.resolve(["stack-2", "HEAD~1", "origin/main", "no-such-ref"]),
+        "read": be.read([heads["stack-2"], get_tree(main_oid)]),
+        "write_commit": write_commit(rewritten),
+        "stacks": [
+            (stack.name, stack.needs_restack(), stack.is_incomplete())
+            for stack in stacks
+        ],
+        "parent": find_branch_parent("main", "stack-3"),
+        "between": refs_between("main", "stack-4"),
+    }
+
+
+def test_state_cache():
+    global _state_cache
+    with tempfile.TemporaryDirectory() as root:
+        make_test_stack(root, 3, with_prs=False)
+        for i in range(20):
+            git("branch", f"plain{i}", "main")
+        list_stacks()
+        state_cache().save()
+        path = githelper_path("cache.json")
+        mtime = os.stat(path).st_mtime_ns
+
+        # A run that only reads from the cache leaves the file alone
+        _state_cache = None
+        invalidate_refs()
+        list_stacks()
+        assert not state_cache().dirty
+        state_cache().save()
+        assert os.stat(path).st_mtime_ns == mtime
+
+        # Moving main replaces the merged entry instead of adding one per branch
+        switch_branch("main")
+        git("commit", "-q", "--allow-empty", "-m", "Main moved")
+        git("push", "-q", "origin", "main")
+        invalidate_refs()
+        list_stacks()
+        entries = state_cache().entries["merged"]
+        assert list(entries) == [get_origin_master()], list(entries)
+        assert entries[get_origin_master()][0][0] == rev_parse("origin/main")
+        print(f"Kept one merged entry for {len(list_branches())} branches")
+
+
+def test_ref_snapshot():
+    with tempfile.TemporaryDirectory() as root:
+        make_test_stack(root, 4, with_prs=False)
+        git("branch", "plain", "main")
+        branches = ["stack-1", "stack-2", "stack-3", "stack-4"]
+        heads = git_lines("rev-parse", *branches)
+        invalidate_refs()
+        with capture_trace() as trace:
+            stack = next(s for s in list_stacks() if s.name == "stack")
+            assert [rev_parse(branch) for branch in branches] == heads
+            assert not stack.needs_restack() and not stack.is_incomplete()
+            assert current_branch() == "stack"
+        calls = trace.names()
+        # Every query above is answered by one listing of the refs
+        assert calls.count("RefSnapshot.__init__") == 1
+        assert not {"git branch", "git rev-parse"} & set(calls)
+        assert refs().upstreams == {"main": "refs/remotes/origin/main"}
+
+        # Moving a ref through githelper replaces the snapshot
+        update_branches({"stack-4": heads[2]})
+        assert rev_parse("stack-4") == heads[2]
+        assert get_stack("stack", required=True).is_incomplete()
+        print("Answered stack queries from one ref snapshot")
+
+
+def test_commit_graph():
+    global _commit_graph, _state_cache
+    depth = 30
+    with tempfile.TemporaryDirectory() as root:
+        make_test_stack(root, depth, with_prs=False)
+        branches = [f"stack-{i}" for i in range(1, depth + 1)]
+        # Start without any of the answers in memory or in the state cache
+        _commit_graph = None
+        _state_cache = StateCache(None)
+        invalidate_refs()
+        with capture_trace() as trace:
+            stack = get_stack("stack", required=True)
+            assert not stack.needs_restack()
+        calls = trace.names()
+        processes = trace.names("process")
+        assert len([c for c in calls if c.endswith(".rev_list")]) == 1
+        # Nothing runs per child. The one merge-base starts the squash-merge index.
+        assert "git branch" not in processes, processes
+        assert processes.count("git merge-base") <= 1, processes
+
+        graph = commit_graph()
+        oids = {branch: rev_parse(branch) for branch in branches}
+        for a, b in [(0, depth - 1), (depth - 1, 0), (5, 6), (6, 5)]:
+            ancestor, ref = oids[branches[a]], oids[branches[b]]
+            assert graph.is_ancestor(ancestor, ref) == backend().is_ancestor(
+                ancestor, ref
+            ), (a, b)
+        path = graph.first_parent_path(oids["stack-1"], oids["stack-30"])
+        assert path == git_lines("rev-list", "--reverse", "stack-1..stack-30")
+
+        # Amending a child in the middle leaves the ones after it behind
+        switch_branch("stack-10")
+        git("commit", "-q", "--amend", "--allow-empty", "-m", "Amended")
+        invalidate_refs()
+        assert get_stack("stack", required=True).needs_restack()
+
+        # The graph can't give a linear path through a merge
+        create_branch("side", "stack-29")
+        git("commit", "-q", "--allow-empty", "-m", "Side")
+        switch_branch("stack")
+        git("merge", "-q", "--no-ff", "-m", "Merge side", "side")
+        tip, side = rev_parse("stack"), rev_parse("side")
+        assert graph.first_parent_path(oids["stack-1"], tip) is None
+        assert graph.is_ancestor(side, tip) and not graph.is_ancestor(tip, side)
+        print(f"Checked a {depth} deep stack with one rev-list")
+
+
+def test_merge_tree_restack():
+    if not supports_merge_tree():
+        sys.stderr.write("SKIP: restacking with merge-tree needs git 2.40\n")
+        sys.exit(TEST_SKIPPED)
+    with tempfile.TemporaryDirectory() as root:
+        make_test_stack(root, 3, with_prs=False, files=True)
+        switch_branch("main")
+        commit_test_file("main.txt", "main\n", "Main moved")
+        git("push", "-q", "origin", "main")
+        switch_branch("stack-2")
+        invalidate_refs()
+
+        def restack() -> List[str]:
+            with capture_trace() as trace:
+                try:
+                    get_stack("stack", required=True).rebase("origin/main")
+                except SystemExit:
+                    pass
+            return trace.names("process")
+
+        processes = restack()
+        assert "git merge-tree" in processes, processes
+        assert processes.count("git update-ref") == 1, processes
+        worktree_cmds = {"git rebase", "git checkout", "git switch", "git reset"}
+        assert not worktree_cmds & set(processes), processes
+        # Only the checked out branch touched the worktree
+        assert current_branch() == "stack-2"
+        assert os.path.exists("main.txt") and git("status", "--porcelain") == ""
+        stack = get_stack("stack", required=True)
+        assert not stack.needs_restack()
+        assert merge_base("stack-1") == rev_parse("origin/main")
+        assert [get_tag(f"stack-{i}") for i in range(1, 4)] == [
+            "stack-1",
+            "stack-2",
+            "stack-3",
+        ]
+
+        # A conflict in the middle of the stack falls back to git rebase from there on
+        switch_branch("main")
+        commit_test_file("stack-2.txt", "main\n", "Conflict")
+        git("push", "-q", "origin", "main")
+        switch_branch("stack")
+        heads = {branch: rev_parse(branch) for branch in ["stack-1", "stack-2"]}
+        processes = restack()
+        assert "git rebase" in processes, processes
+        last_merge_tree = len(processes) - processes[::-1].index("git merge-tree")
+        assert "git rebase" not in processes[:last_merge_tree], processes
+        journal = RestackJournal.load()
+        assert journal is not None and rebase_in_progress()
+        assert journal.steps[0]["new"] is not None and journal.steps[1]["new"] is None
+        journal.abort()
+        assert {branch: rev_parse(branch) for branch in heads} == heads
+        print("Restacked with merge-tree and fell back to git rebase on a conflict")
+
+
+def test_backends():
+    if not pygit2_supported():
+        print("A supported pygit2 is not installed, skipping")
+        return
+    # An older pygit2, like distros ship, leaves auto on the subprocess backend
+    original_backend, version = BACKEND, pygit2.__version__
+    pygit2.__version__ = "1.11.1"
+    reset_backend("auto")
+    assert type(backend()) is GitBackend
+    pygit2.__version__ = version
+    reset_backend(original_backend)
+    global CACHE_ENABLED, _state_cache
+    with tempfile.TemporaryDirectory() as root:
+        make_test_stack(root, 4, with_prs=False)
+        # A stack that needs a restack, a branch with an upstream that has moved on,
+        # and one whose upstream is gone
+        switch_branch("stack-2")
+        git("commit", "-q", "--amend", "--allow-empty", "-m", "Commit 2 amended")
+        create_branch("other", "main")
+        git("commit", "-q", "--allow-empty", "-m", "Other")
+        git("push", "-q", "-u", "origin", "other")
+        git("reset", "-q", "--hard", "HEAD~1")
+        create_branch("gone", "main")
+        git("push", "-q", "-u", "origin", "gone")
+        git("push", "-q", "origin", ":gone")
+        switch_branch("stack")
+
+        CACHE_ENABLED = False
+        results = {}
+        for name in ["subprocess", "pygit2"]:
+            reset_backend(name)
+            _state_cache = None
+            results[name] = backend_results()
+        for key, expected in results["subprocess"].items():
+            actual = results["pygit2"][key]
+            assert actual == expected, f"{key}: {actual} != {expected}"
+        print(f"Backends agree on {len(results['subprocess'])} queries")
+
+
+BENCH_COMMANDS = {
+    # name: (branch to run on, githelper args)
+    "list": ("main", ["stack", "list"]),
+    "status": ("stack0", ["stack", "status"]),
+    "restack": ("stack0", ["stack", "restack"]),
+    "create": ("fresh", ["stack", "create"]),
+    "push": ("stack0", ["stack", "push", "-a", "-f"]),
+    # The last stack has no PRs yet
+    "pr": ("{last_stack}", ["stack", "pr", "-a"]),
+}
+
+
+def _add_cmd_bench(parser):
+    parser.add_argument(
+        "--branches", type=int, default=50, help="Number of plain branches"
+    )
+    parser.add_argument("--stacks", type=int, default=5, help="Number of stacks")
+    parser.add_argument("--depth", type=int, default=8, help="Branches per stack")
+    parser.add_argument(
+        "--history", type=int, default=1000, help="Number of commits on main"
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.1, help="Seconds of latency per gh call"
+    )
+    parser.add_argument(
+        "-r",
+        "--repeat",
+        type=int,
+        default=3,
+        help="Times to run each command, once cold and once warm",
+    )
+    parser.add_argument(
+        "-c",
+        "--commands",
+        default=",".join(BENCH_COMMANDS),
+        help="Comma-separated commands to time",
+    )
+    parser.add_argument(
+        "--maintain",
+        action="store_true",
+        help="Run 'maintain' on the repo first, to compare with a run without it",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        default="githelper-bench.json",
+        help="Where to write the results as JSON",
+    )
+
+
+def cmd_bench(args):
+    """Time stack commands against a synthetic repo and a fake gh"""
+    commands = args.commands.split(",")
+    for name in commands:
+        if name not in BENCH_COMMANDS:
+            sys.stderr.write(f"Unknown benchmark command {name}\n")
+            sys.exit(1)
+    output = os.path.abspath(args.output)
+    with open(__file__, "rb") as ifile:
+        script_hash = hashlib.sha1(ifile.read()).hexdigest()
+    results: Dict[str, Any] = {
+        "script": script_hash,
+        "git": ".".join(map(str, git_version())),
+        "backend": BACKEND,
+        "params": {
+            "branches": args.branches,
+            "stacks": args.stacks,
+            "depth": args.depth,
+            "history": args.history,
+            "latency": args.latency,
+            "repeat": args.repeat,
+            "maintain": args.maintain,
+        },
+        "commands": {},
+    }
+    with tempfile.TemporaryDirectory() as root:
+        start = time.perf_counter()
+        state_file = make_bench_repo(
+            root, args.branches, args.stacks, args.depth, args.history, args.latency
+        )
+        print(f"Created repo in {time.perf_counter() - start:.1f}s")
+        if args.maintain:
+            start = time.perf_counter()
+            maintain()
+            print(f"Maintained repo in {time.perf_counter() - start:.1f}s")
+        with open(state_file, "r", encoding="utf-8") as ifile:
+            gh_state = ifile.read()
+        saved_refs = bench_refs()
+
+        env = dict(os.environ, GITHELPER_BACKEND=BACKEND)
+        print(f"{'Command':<10} {'Cache':<5} {'Min':>8} {'Median':>8} {'Max':>8}")
+        for name in commands:
+            branch, cmd = BENCH_COMMANDS[name]
+            runs: Dict[str, List[float]] = {"cold": [], "warm": []}
+            for _ in range(args.repeat):
+                # Each cold run starts without .git/githelper, the warm run reuses its state
+                reset_bench_state()
+                for kind in ["cold", "warm"]:
+                    restore_bench_refs(saved_refs)
+                    with open(state_file, "w", encoding="utf-8") as ofile:
+                        ofile.write(gh_state)
+                    git(
+                        "checkout",
+                        "-q",
+                        "-f",
+                        branch.format(last_stack=f"stack{args.stacks - 1}"),
+                    )
+                    start = time.perf_counter()
+                    subprocess.run(
+                        [sys.executable, os.path.abspath(__file__), *cmd],
+                        env=env,
+                        capture_output=True,
+                        check=True,
+                    )
+                    runs[kind].append(time.perf_counter() - start)
+            results["commands"][name] = {}
+            for kind, times in runs.items():
+                ordered = sorted(times)
+                summary = {
+                    "runs": times,
+                    "min": ordered[0],
+                    "median": ordered[len(ordered) // 2],
+                    "max": ordered[-1],
+                }
+                results["commands"][name][kind] = summary
+                stats = [summary[key] for key in ["min", "median", "max"]]
+                print(f"{name:<10} {kind:<5}" + "".join(f" {t:>8.3f}" for t in stats))
+    with open(output, "w", encoding="utf-8") as ofile:
+        json.dump(results, ofile, indent=2)
+    print(f"Wrote results to {output}")
+
+
+def reset_bench_state():
+    """Drop the caches and PR state in .git/githelper, but keep the maintenance record"""
+    path = os.path.join(git_common_dir(), "githelper")
+    if not os.path.isdir(path):
+        return
+    for entry in os.listdir(path):
+        if entry in ("maintain.json", "lock"):
+            continue
+        full = os.path.join(path, entry)
+        if os.path.isdir(full):
+            shutil.rmtree(full)
+        else:
+            os.remove(full)
+
+
+def make_bench_repo(
+    root: str, branches: int, stacks: int, depth: int, history: int, latency: float
+) -> str:
+    """Generate a repo with history on main, plain branches, stacks, and a fake gh
+
+    stack0 needs a restack, the last stack has no PRs, and 'fresh' has unstacked
+    commits. Returns the fake gh state file.
+    """
+    make_test_repo(root)
+    stream = []
+    when = 1700000000
+    mark = 0
+
+    def commit(ref: str, parent: str, message: str, path: str) -> str:
+        nonlocal mark, when
+        mark += 1
+        when += 60
+        message_data = message.encode("utf-8")
+        content = f"{mark}\n".encode("utf-8")
+        stream.append(
+            f"commit {ref}\nmark :{mark}\n"
+            f"committer {USER} <{USER}@localhost> {when} +0000\n"
+            f"data {len(message_data)}\n{message}\n"
+            f"from {parent}\n"
+            f"M 644 inline {path}\ndata {len(content)}\n{content.decode()}\n"
+        )
+        return f":{mark}"
+
+    main = "refs/heads/main^0"
+    history_marks = []
+    for i in range(history):
+        main = commit("refs/heads/main", main, f"Main commit {i}", f"main/{i % 100}")
+        history_marks.append(main)
+    for i in range(branches):
+        base = history_marks[i * history // branches] if history else main
+        commit(f"refs/heads/topic{i}", base, f"Topic {i}", f"topic/{i}")
+
+    prs = []
+    number = 100
+    for j in range(stacks):
+        name = f"stack{j}"
+        rows = [
+            {"": str(i), "PR": f"#{number + i}", "Title": f"{name} commit {i}"}
+            for i in range(1, depth + 1)
+        ]
+        table = make_markdown_table(rows, ["", "PR", "Title"])
+        parent = main
+        for i in range(1, depth + 1):
+            number += 1
+            branch = f"{name}-{i}"
+            parent = commit(
+                "refs/heads/" + branch,
+                parent,
+                f"{name} commit {i}\n\nbranch: {branch}",
+                f"{name}/{i}",
+            )
+            if j == stacks - 1:
+                continue
+            prs.append(
+                {
+                    "id": f"PR_{number}",
+                    "number": number,
+                    "title": f"[{i}/{depth}] {name} commit {i}",
+                    "body": table + "\n",
+                    "url": f"https://github.com/{USER}/test/pull/{number}",
+                    "isDraft": False,
+                    "headRefName": branch,
+                    "state": "OPEN",
+                }
+            )
+        stream.append(f"reset refs/heads/{name}\nfrom {parent}\n\n")
+    parent = main
+    for i in range(1, depth + 1):
+        parent = commit("refs/heads/fresh", parent, f"Fresh commit {i}", f"fresh/{i}")
+    git("fast-import", "--quiet", input="".join(stream).encode("utf-8"))
+
+    pushed = [branch for branch in list_branches() if branch != "fresh"]
+    git("push", "-q", "origin", *pushed)
+    git("reset", "-q", "--hard", "main")
+    if stacks:
+        # Amend the first child of stack0 so it needs a restack
+        git("checkout", "-q", "stack0-1")
+        git(
+            "commit",
+            "-q",
+            "--amend",
+            "-m",
+            "stack0 commit 1 (amended)\n\nbranch: stack0-1",
+        )
+        git("checkout", "-q", "main")
+    return install_fake_gh(root, prs, latency)
+
+
+def bench_refs() -> Dict[str, Dict[str, str]]:
+    """The branches of the bench repo and its origin"""
+    ret = {}
+    for git_dir in [".git", os.path.join("..", "origin.git")]:
+        ret[git_dir] = {}
+        for line in git_lines(
+            "--git-dir",
+            git_dir,
+            "for-each-ref",
+            "--format=%(refname) %(objectname) %(symref)",
+            "refs/heads",
+            "refs/remotes",
+            "refs/githelper",
+        ):
+            refname, oid, *symref = line.split()
+            if not symref:
+                ret[git_dir][refname] = oid
+    return ret
+
+
+def restore_bench_refs(saved: Dict[str, Dict[str, str]]):
+    for git_dir, current in bench_refs().items():
+        lines = [f"delete {ref}\n" for ref in current if ref not in saved[git_dir]] + [
+            f"update {ref} {oid}\n" for ref, oid in saved[git_dir].items()
+        ]
+        git(
+            "--git-dir", git_dir, "update-ref", "--stdin", input="".join(lines).encode()
+        )
+
+
+def cmd_fake_gh(args):
+    """Minimal stand-in for the gh cli, used by the tests"""
+    state_file = os.environ["GITHELPER_FAKE_GH_STATE"]
+    time.sleep(float(os.environ.get("GITHELPER_FAKE_GH_LATENCY", "0")))
+    with open(state_file, "r+", encoding="utf-8") as state_io:
+        fcntl.flock(state_io, fcntl.LOCK_EX)
+        state = json.load(state_io)
+        state["calls"].append(args.gh_args)
+        output = fake_gh_handle(state, args.gh_args)
+        state_io.seek(0)
+        state_io.truncate()
+        json.dump(state, state_io)
+    if output is not None:
+        print(json.dumps(output))
+
+
+def fake_gh_handle(state: Dict[str, Any], cmd: List[str]) -> Optional[Any]:
+    prs: List[Dict[str, Any]] = state["prs"]
+
+    def find_pr(ref: str) -> Dict[str, Any]:
+        for pr in prs:
+            if ref in (str(pr["number"]), pr["headRefName"], pr["id"], pr["url"]):
+                return pr
+        sys.stderr.write(f"no pull requests found for {ref}\n")
+        sys.exit(1)
+
+    def pr_json(pr: Dict[str, Any], fields: str) -> Dict[str, Any]:
+        return {field: pr.get(field) for field in fields.split(",")}
+
+    # Bumped on every change, like GitHub's updatedAt
+    now = f"2024-01-01T00:00:00.{len(state['calls']):06d}Z"
+    for pr in prs:
+        pr.setdefault("updatedAt", "2024-01-01T00:00:00Z")
+
+    params = {}
+    for flag, param in zip(cmd, cmd[1:]):
+        if flag in ("-f", "-F"):
+            key, _, value = param.partition("=")
+            params[key] = value
+
+    if cmd[:2] == ["auth", "status"]:
+        return None
+    elif cmd[:2] == ["pr", "list"]:
+        fields = cmd[cmd.index("--json") + 1]
+        limit = int(cmd[cmd.index("--limit") + 1])
+        state = cmd[cmd.index("--state") + 1].upper()
+        # Newest first, like gh
+        return [
+            pr_json(pr, fields)
+            for pr in reversed(prs)
+            if state == "ALL" or pr["state"] == state
+        ][:limit]
+    elif cmd[:2] == ["pr", "view"]:
+        fields = cmd[cmd.index("--json") + 1]
+        return pr_json(find_pr(cmd[2]), fields)
+    elif cmd[:2] == ["api", "repos/{owner}/{repo}/pulls"]:
+        number = 100 + len(prs) + 1
+        pr = {
+            "id": f"PR_{number}",
+            "number": number,
+            "title": params["title"],
+            "body": params["body"],
+            "url": f"https://github.com/{USER}/test/pull/{number}",
+            "isDraft": params["draft"] == "true",
+            "headRefName": params["head"],
+            "baseRefName": params["base"],
+            "state": "OPEN",
+            "updatedAt": now,
+        }
+        prs.append(pr)
+        return {
+            "node_id": pr["id"],
+            "number": number,
+            "title": pr["title"],
+            "body": pr["body"],
+            "html_url": pr["url"],
+            "draft": pr["isDraft"],
+        }
+    elif cmd[:2] == ["api", "graphql"] and params["query"].startswith("mutation"):
+        data = {}
+        for alias, mutation, fields in re.findall(
+            r"(\w+): (\w+)\(input: \{([^}]*)\}\)", params["query"]
+        ):
+            values = dict(re.findall(r"(\w+): (\"[^\"]*\"|\$\w+)", fields))
+            values = {
+                key: params[val[1:]] if val.startswith("$") else val.strip('"')
+                for key, val in values.items()
+            }
+            pr = find_pr(values.pop("pullRequestId"))
+            pr["updatedAt"] = now
+            if mutation == "convertPullRequestToDraft":
+                pr["isDraft"] = True
+            elif mutation == "markPullRequestReadyForReview":
+                pr["isDraft"] = False
+            else:
+                pr.update(values)
+            data[alias] = {"pullRequest": {"number": pr["number"]}}
+        return {"data": data}
+    elif cmd[:2] == ["api", "graphql"]:
+        repository = {}
+        for alias, num, fields in re.findall(
+            r"(\w+): pullRequest\(number: (\d+)\) \{([^}]*)\}", params["query"]
+        ):
+            repository[alias] = pr_json(find_pr(num), ",".join(fields.split()))
+        return {"data": {"repository": repository}}
+    else:
+        sys.stderr.write(f"fake gh: unsupported command {cmd}\n")
+        sys.exit(1)
+
+
 def main() -> None:
     """Main method"""
+    global OFFLINE, PR_CACHE_TTL
     parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Don't read or write the stack state cache in .git/githelper/. The patch id index of the main branch is still kept",
+    )
+    parser.add_argument(
+        "--cache-stats",
+        action="store_true",
+        help="Print the stack state cache hit rate when done",
+    )
+    parser.add_argument(
+        "--trace",
+        action="store_true",
+        help="Record git/gh calls and time spent in helpers as a Chrome trace and print a summary",
+    )
+    parser.add_argument(
+        "--trace-file",
+        metavar="FILE",
+        help="Where --trace writes the trace (default githelper-trace.json). Implies --trace",
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="Serve PRs entirely from the cache in .git/githelper/prs and never call gh",
+    )
+    parser.add_argument(
+        "--pr-ttl",
+        type=float,
+        default=PR_CACHE_TTL,
+        metavar="SECONDS",
+        help="How long 'stack status' trusts the PR cache before refreshing it (default %(default)s, or GITHELPER_PR_TTL)",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=["auto", "subprocess", "pygit2"],
+        default=BACKEND,
+        help="How to read the repository. 'auto' uses pygit2 when a recent enough version is installed",
+    )
 
     subparsers = parser.add_subparsers(dest="cmd")
 
@@ -1022,15 +4795,60 @@ def main() -> None:
     _add_cmd_stack(stack_parser)
     _add_cmd_test(subparsers.add_parser("test"))
     _add_cmd_update(subparsers.add_parser("update"))
+    _add_cmd_bench(
+        subparsers.add_parser(
+            "bench", help="Time stack commands against a synthetic repo"
+        )
+    )
+    _add_cmd_maintain(
+        subparsers.add_parser(
+            "maintain",
+            help="Refresh the commit-graph and reachability bitmaps that speed up history walks",
+        )
+    )
+    _add_cmd_hook(
+        subparsers.add_parser(
+            "hook",
+            help="Hooks that keep stack metadata up to date (see 'hook install')",
+        )
+    )
+    fake_gh_parser = subparsers.add_parser("fake-gh")
+    fake_gh_parser.add_argument("gh_args", nargs=argparse.REMAINDER)
 
     args = parser.parse_args()
+    os.environ["GITHELPER_RUNNING"] = "1"
+    reset_backend(args.backend)
+    if args.trace or args.trace_file:
+        global _tracer
+        _tracer = Tracer(os.path.abspath(args.trace_file or "githelper-trace.json"))
+        atexit.register(_tracer.finish)
+    if args.no_cache:
+        global CACHE_ENABLED
+        CACHE_ENABLED = False
+    OFFLINE = args.offline
+    PR_CACHE_TTL = args.pr_ttl
+    if args.cache_stats:
+        atexit.register(lambda: state_cache().print_stats())
 
     if args.cmd == "stack":
-        cmd_stack(args, stack_parser)
+        if getattr(args, "stack_cmd", None) in LOCKED_STACK_COMMANDS:
+            with repo_lock():
+                cmd_stack(args, stack_parser)
+        else:
+            cmd_stack(args, stack_parser)
     elif args.cmd == "update":
-        cmd_update(args)
+        with repo_lock():
+            cmd_update(args)
     elif args.cmd == "test":
         cmd_test(args)
+    elif args.cmd == "bench":
+        cmd_bench(args)
+    elif args.cmd == "maintain":
+        cmd_maintain(args)
+    elif args.cmd == "hook":
+        cmd_hook(args)
+    elif args.cmd == "fake-gh":
+        cmd_fake_gh(args)
     else:
         parser.print_help()
 